@@ -28,6 +28,24 @@ embed_lyrics: Embed the unsynced lyrics inside a FLAC/MP4 file
 genre_language: Select the language of the genres from Deezer to "en-US", "de", "fr", ...
 artwork_size: Downloads (artwork_size)x(artwork_size) album covers from iTunes, set it to 0 to disable iTunes cover
 resolution: Which resolution you want to download the videos
+download_connections: (optional) Split every track into this many byte ranges which are downloaded at once,
+    helps on high-latency routes where a single connection is slow. Defaults to 1
+segment_workers: (optional) How many segments of a DASH stream are downloaded at once. Defaults to 8
+lyrics_workers: (optional) How many lyrics of the tracks of a release are fetched at once. Defaults to 4
+pipe_video_segments: (optional) Pipe the video segments straight into ffmpeg instead of saving them to a tmp folder
+    first, halves the disk usage but an interrupted video download starts over. Defaults to False
+stage_workers: (optional) Worker threads per download stage, e.g. {"fetch": 4, "convert": 2}. The stages are resolve,
+    playback, fetch, decrypt, convert and tag, each defaults to 1 worker. -w/--workers overrides the fetch workers
+dedup_isrc: (optional) Hardlink a track from the library index instead of downloading it again, if the same recording
+    (ISRC) already exists in the same quality. A recording of another release is copied and tagged again. Defaults to False
+resolve_workers: (optional) How many threads resolve the track and album items of a queue (e.g. from -f) in the
+    background. Defaults to 4
+resolve_rate: (optional) Maximum requests per second made to resolve queue items in the background. Defaults to 10
+prefetch_tracks: (optional) How many of the following tracks get their stream URL and metadata fetched while the
+    current track downloads, expired stream URLs are fetched again. 0 disables it. Defaults to 2
+rate_limits: (optional) Maximum requests per second and concurrent requests per account, for each endpoint class:
+    {'metadata': (10, 8), 'playback': (4, 4), 'cdn': (50, 16)}. Both are halved after a HTTP 429 and then slowly
+    raised again. Missing classes keep their defaults
 
 Format variables are {title}, {artist}, {album}, {tracknumber}, {discnumber}, {date}, {quality}, {explicit}.
 quality: has a whitespace in front, so it will look like this " [Dolby Atmos]", " [360]" or " [M]" according to the downloaded quality
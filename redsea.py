@@ -4,14 +4,24 @@ import traceback
 import sys
 import os
 import re
+import threading
+import time
 import urllib3
 
 import redsea.cli as cli
+import redsea.ratelimit as ratelimit
 
-from redsea.mediadownloader import MediaDownloader
+from redsea.mediadownloader import MediaDownloader, DownloadJob
 from redsea.tagger import Tagger
 from redsea.tidal_api import TidalApi, TidalError
 from redsea.sessions import RedseaSessionFile
+from redsea.cache import SqliteCache
+from redsea.library import LibraryIndex
+from redsea.journal import QueueJournal
+from redsea.resolver import QueueResolver
+from redsea.prefetch import Prefetcher
+from redsea.refresher import TokenRefresher
+from redsea.sessionpool import SessionPool
 
 from config.settings import PRESETS, BRUTEFORCEREGION
 
@@ -49,8 +59,42 @@ def main():
     preset['quality'].append('HIGH') if preset['AAC_320'] else None
     preset['quality'].append('LOW') if preset['AAC_96'] else None
 
+    # Worker count per download stage, --workers sets the number of fetch workers
+    stage_workers = {}
+    if 'stage_workers' in preset:
+        stage_workers.update(preset['stage_workers'])
+    if args.workers > 1:
+        stage_workers['fetch'] = args.workers
+
+    # Requests are spaced per account and endpoint class, see ratelimit.RATE_LIMITS
+    if 'rate_limits' in preset:
+        ratelimit.configure(preset['rate_limits'])
+
+    # Metadata responses are cached in memory and in ./config/cache.sqlite across runs
+    if args.no_cache:
+        TidalApi.cache.enabled = False
+    else:
+        TidalApi.cache.store = SqliteCache('./config/cache.sqlite', refresh_before=time.time() if args.refresh else None)
+
+    # Downloaded tracks are recorded in ./config/library.sqlite to skip them without any request
+    library = LibraryIndex('./config/library.sqlite')
+
+    # Index existing files, e.g. downloaded by older versions
+    if args.urls[0] == 'library':
+        if len(args.urls) == 3 and args.urls[1] == 'scan':
+            library.scan(args.urls[2], workers=args.workers if args.workers > 1 else None)
+        else:
+            print('\nThe "library" command provides the following methods:')
+            print('\n  scan:     Reads the tags of all FLAC and M4A files below a path and adds them to the library '
+                  'index, so they are skipped by later downloads to this path. Only new or changed files are read '
+                  'on later scans')
+            print('\nUsage: redsea.py library scan /path/to/music\n')
+        exit()
+
     # Check for auth flag / session settings
     RSF = RedseaSessionFile('./config/sessions.pk')
+    # Tokens of Mobile/TV sessions are renewed in the background before they expire
+    TidalApi.refresher = TokenRefresher(RSF).start()
     if args.urls[0] == 'auth' and len(args.urls) == 1:
         print('\nThe "auth" command provides the following methods:')
         print('\n  list:     Lists stored sessions if any exist')
@@ -285,25 +329,73 @@ def main():
             #    media_to_download = [{'id': str(searchresult[searchtype]['items'][chosen]['id']), 'type': 'p'}]
             break
 
+    elif args.file:
+        # Read while downloading, so long input files or stdin are never held in memory
+        media_to_download = cli.iter_media_option(args.urls, args.file)
+
     else:
         media_to_download = cli.parse_media_option(args.urls, args.file)
 
     print(LOGO)
 
+    # The length of a queue read from a file is not known in advance
+    if isinstance(media_to_download, list):
+        queue_key = media_to_download
+        total_items = len(media_to_download)
+    else:
+        queue_key = ['file', args.urls[0] if args.urls[0] == '-' else os.path.abspath(args.urls[0])]
+        total_items = None
+
+    # Resolved tracks and their states are journaled, so an interrupted run with the same inputs is continued
+    journal = QueueJournal.for_queue('./config/journal', args.preset, queue_key, restart=args.restart)
+    if journal.resuming:
+        print('<<< Resuming the interrupted run, pass --restart to start over >>>\n')
+
+    # Queue items are read and their tracks and albums resolved in the background, a bounded window ahead
+    # One TidalApi and MediaDownloader serve the whole queue, they share the pooled HTTP sessions
+    api = TidalApi(RSF.load_session(args.account))
+    md = MediaDownloader(api, preset.copy(), Tagger(preset))
+    md.library = library
+
+    # Downloads are spread over all eligible accounts, each with its own rate budget and connection pool
+    pool = None
+    if args.balance:
+        pool = SessionPool(api, RSF.get_session())
+        print('<<< Balancing downloads over {} session(s) >>>\n'.format(len(pool)))
+
+    resolver = QueueResolver(api, media_to_download,
+                             workers=preset['resolve_workers'] if 'resolve_workers' in preset else 4,
+                             rate=preset['resolve_rate'] if 'resolve_rate' in preset else 10,
+                             skip=lambda item, media: journal.is_resolved(item, media) or journal.is_done(item, media)
+                             ).start()
+
     # Loop through media and download if possible
     cm = 0
-    for mt in media_to_download:
+    failed_lock = threading.Lock()
+    for item, mt in resolver:
 
         # Is it an acceptable media type? (skip if not)
         if not mt['type'] in MEDIA_TYPES:
             print('Unknown media type - ' + mt['type'])
+            # Nothing to download, it does not keep the journal from compacting the finished items
+            journal.set_item_done(item, mt)
             continue
 
         cm += 1
-        print('<<< Getting {0} info... >>>'.format(MEDIA_TYPES[mt['type']]))
+        if journal.is_done(item, mt):
+            print('<<< Skipping {0} {1}, already finished by the interrupted run >>>\n'.format(
+                MEDIA_TYPES[mt['type']], mt['id']))
+            continue
+
+        if total_items != 1:
+            print('<<< Getting {0} info... ({1}/{2} items resolved) >>>'.format(
+                MEDIA_TYPES[mt['type']], resolver.resolved, resolver.count or '?'))
+        else:
+            print('<<< Getting {0} info... >>>'.format(MEDIA_TYPES[mt['type']]))
 
-        # Create a new TidalApi and pass it to a new MediaDownloader
-        md = MediaDownloader(TidalApi(RSF.load_session(args.account)), preset.copy(), Tagger(preset))
+        # Start every item with the default session and the preset's options, a previous item may have changed them
+        md.api = api
+        md.opts = preset.copy()
 
         # Create a new session generator in case we need to switch sessions
         session_gen = RSF.get_session()
@@ -315,18 +407,24 @@ def main():
             media_info = None
             track_info = []
 
+            # Resolved in the background already
+            resolved = resolver.get(item)
+
             while True:
                 try:
                     if media['type'] == 'f':
-                        lines = media['content'].split('\n')
-                        for i, l in enumerate(lines):
+                        lines = [l.strip() for l in media['content'].split('\n') if l.strip()]
+                        # Look up 50 tracks per request, unavailable ones are requested one by one
+                        for i in range(0, len(lines), 50):
                             print('Getting info for track {}/{}'.format(i, len(lines)), end='\r')
-                            tracks.append(md.api.get_track(l))
+                            found = {str(t['id']): t for t in md.api.get_tracks(lines[i:i + 50])}
+                            for l in lines[i:i + 50]:
+                                tracks.append(found[l] if l in found else md.api.get_track(l))
                         print()
 
                     # Track
                     elif media['type'] == 't':
-                        tracks.append(md.api.get_track(media['id']))
+                        tracks.append(resolved if resolved is not None else md.api.get_track(media['id']))
 
                     # Playlist
                     elif media['type'] == 'p':
@@ -355,11 +453,14 @@ def main():
 
                     # Album
                     elif media['type'] == 'a':
-                        # Get album information
-                        media_info = md.api.get_album(media['id'])
+                        if resolved is not None:
+                            media_info, tracks = resolved
+                        else:
+                            # Get album information
+                            media_info = md.api.get_album(media['id'])
 
-                        # Get a list of the tracks from the album
-                        tracks = md.api.get_album_tracks(media['id'])['items']
+                            # Get a list of the tracks from the album
+                            tracks = md.api.get_album_tracks(media['id'])['items']
 
                     # Video
                     elif media['type'] == 'v':
@@ -446,12 +547,27 @@ def main():
                     else:
                         raise(e)
 
-        try:
-            media_name, track_info = get_tracks(media=mt)
-        except StopIteration:
-            # Let the user know we cannot download this release and skip it
-            print('None of the available accounts were able to get info for release {}. Skipping..'.format(mt['id']))
-            continue
+        journaled = journal.get_resolved(item, mt)
+        if journaled is not None:
+            media_name, name = journaled['media_name'], journaled['name']
+            track_info = [(tracks, media_info) for tracks, media_info in journaled['track_info']]
+            md.opts['path'] = journaled['path']
+        else:
+            try:
+                media_name, track_info = get_tracks(media=mt)
+            except StopIteration:
+                # Let the user know we cannot download this release and skip it
+                print('None of the available accounts were able to get info for release {}. Skipping..'.format(mt['id']))
+                journal.set_item_done(item, mt, reason='no session could get the release info')
+                continue
+
+            if mt['type'] == 'p':
+                name = md.playlist_from_id(mt['id'])['title']
+            else:
+                name = track_info[0][1]['title'] if track_info[0][1] else None
+
+            journal.set_resolved(item, mt, {'media_name': media_name, 'name': name, 'track_info': track_info,
+                                        'path': md.opts['path']})
 
         total = sum([len(t[0]) for t in track_info])
 
@@ -461,97 +577,212 @@ def main():
 
         # Playlist or album
         else:
-            if mt['type'] == 'p':
-                name = md.playlist_from_id(mt['id'])['title']
-            else:
-                name = track_info[0][1]['title']
-                
             print('<<< Downloading {0} "{1}": {2} track(s) in total >>>'.format(
                 MEDIA_TYPES[mt['type']] + (' ' + media_name if media_name else ''), name, total))
 
-        if args.resumeon and len(media_to_download) == 1 and mt['type'] == 'p':
+        if args.resumeon and total_items == 1 and mt['type'] == 'p':
             print('<<< Resuming on track {} >>>'.format(args.resumeon))
             args.resumeon -= 1
         else:
             args.resumeon = 0
 
-        cur = args.resumeon
-        for tracks, media_info in track_info:
-            for track in tracks[args.resumeon:]:
-                first = True
-
-                # Actually download the track (finally)
-                while True:
+        def handle_error(job, e):
+            '''
+            Prints what went wrong with a job, returns True if it should be attempted again
+            '''
+            track = job.track_info
+
+            # Catch quality error
+            if isinstance(e, ValueError):
+                print("\t" + str(e))
+                traceback.print_exception(type(e), e, e.__traceback__)
+                if args.skip is True:
+                    print('Skipping track "{} - {}" due to insufficient quality'.format(
+                        track['artist']['name'], track['title']))
+                else:
+                    print('Halting on track "{} - {}" due to insufficient quality'.format(
+                        track['artist']['name'], track['title']))
+                return False
+
+            # Catch file name errors
+            elif isinstance(e, OSError):
+                print(e)
+                print("\tFile name too long or contains apostrophes")
+                with failed_lock:
+                    file = open('failed_tracks.txt', 'a')
+                    file.write(str(track['url']) + "\n")
+                    file.close()
+                return False
+
+            # Catch session audio stream privilege error
+            elif isinstance(e, AssertionError):
+                if 'Unable to download track' in str(e) and BRUTEFORCE:
+
+                    # Try again with a different session
                     try:
-                        md.download_media(track, media_info, overwrite=args.overwrite,
-                                          track_num=cur+1 if mt['type'] == 'p' else None)
-                        break
+                        # Reset generator if this is the first attempt
+                        if job.session_gen is None:
+                            job.session_gen = RSF.get_session()
+                        session, name = next(job.session_gen)
+                        job.api = TidalApi(session)
+                        print('Attempting audio stream with session "{}" in region {}'.format(name, session.country_code))
+                        return True
+
+                    # Ran out of sessions, skip track
+                    except StopIteration:
+                        # Let the user know we cannot download this release and skip it
+                        print('None of the available accounts were able to download track {}. Skipping..'.format(track['id']))
+                        return False
+
+                elif 'Please use a mobile session' in str(e):
+                    print(e)
+                    print('Choose one of the following mobile sessions: ')
+                    RSF.list_sessions(True)
+                    return False
+
+                # Skip
+                else:
+                    print(str(e) + '. Skipping..')
+                    return False
+
+            raise e
+
+        def print_progress():
+            # Progress of current track
+            print('=== {0}/{1} complete ({2:.0f}% done) ===\n'.format(cur, total, (cur / total) * 100))
+
+        jobs = []
+        keys = {}
+        done = 0
+        for group, (tracks, media_info) in enumerate(track_info):
+            # Album metadata, credits and lyrics are fetched once for all tracks of a release
+            album = None
+            if media_info is not None:
+                album = md.album_context(media_info['id'], media_info)
+            # Lyrics are only prefetched for the tracks which are downloaded
+            downloaded = []
+
+            for position, track in enumerate(tracks):
+                if position < args.resumeon:
+                    continue
 
-                    # Catch quality error
-                    except ValueError as e:
-                        print("\t" + str(e))
-                        traceback.print_exc()
-                        if args.skip is True:
-                            print('Skipping track "{} - {}" due to insufficient quality'.format(
-                                track['artist']['name'], track['title']))
-                            break
-                        else:
-                            print('Halting on track "{} - {}" due to insufficient quality'.format(
-                                track['artist']['name'], track['title']))
-                            break
+                key = '{}:{}'.format(group, position)
+                if journal.state(item, mt, key) == 'done':
+                    done += 1
+                    continue
 
-                    # Catch file name errors
-                    except OSError as e:
-                        print(e)
-                        print("\tFile name too long or contains apostrophes")
-                        file = open('failed_tracks.txt', 'a')
-                        file.write(str(track['url']) + "\n")
-                        file.close()
-                        break
+                keys[len(jobs)] = key
+                job = DownloadJob(md.api, track, media_info, overwrite=args.overwrite,
+                                  track_num=position + 1 if mt['type'] == 'p' else None,
+                                  index=len(jobs), album=album)
+                jobs.append(job)
+                if track['allowStreaming'] and not md._indexed(job):
+                    downloaded.append(track['id'])
+
+            if album is not None:
+                album.add_tracks(downloaded)
+
+        if done:
+            print('<<< {} track(s) already downloaded by the interrupted run >>>'.format(done))
+
+        # Playback info and metadata of the next tracks are fetched while the current one downloads
+        prefetcher = None
+        lookahead = preset['prefetch_tracks'] if 'prefetch_tracks' in preset else 2
+        if lookahead > 0:
+            prefetcher = Prefetcher(md.prefetch_job, lookahead)
+
+        cur = args.resumeon + done
+        start = cur
+        if stage_workers:
+            # Run the stages concurrently, jobs finish out of order but progress is printed in queue order
+            pipeline = md.pipeline(stage_workers, queue_size=args.workers * 2).start()
+            def feed():
+                for i, job in enumerate(jobs):
+                    if pool is not None:
+                        # The prefetched jobs need their session before their stream URL is fetched
+                        for upcoming in jobs[i:i + 1 + (prefetcher.lookahead if prefetcher is not None else 0)]:
+                            pool.assign(upcoming)
+                    if prefetcher is not None:
+                        prefetcher.schedule(jobs[i + 1:])
+                    journal.set_state(item, keys[job.index], 'downloading')
+                    pipeline.submit(job)
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+
+            finished = set()
+            while cur - start < len(jobs):
+                if cur - start in finished:
+                    cur += 1
+                    print_progress()
+                    continue
 
-                    # Catch session audio stream privilege error
-                    except AssertionError as e:
-                        if 'Unable to download track' in str(e) and BRUTEFORCE:
-
-                            # Try again with a different session
-                            try:
-                                # Reset generator if this is the first attempt
-                                if first:
-                                    session_gen = RSF.get_session()
-                                    first = False
-                                session, name = next(session_gen)
-                                md.api = TidalApi(session)
-                                print('Attempting audio stream with session "{}" in region {}'.format(name, session.country_code))
-                                continue
-
-                            # Ran out of sessions, skip track
-                            except StopIteration:
-                                # Let the user know we cannot download this release and skip it
-                                print('None of the available accounts were able to download track {}. Skipping..'.format(track['id']))
-                                break
-
-                        elif 'Please use a mobile session' in str(e):
-                            print(e)
-                            print('Choose one of the following mobile sessions: ')
-                            RSF.list_sessions(True)
-                            break
+                job = pipeline.get()
+                if job.error is not None and handle_error(job, job.error):
+                    pipeline.submit(job)
+                else:
+                    if job.error is not None:
+                        journal.set_state(item, keys[job.index], 'failed', str(job.error))
+                    else:
+                        journal.set_state(item, keys[job.index], 'done')
+                    if pool is not None:
+                        pool.release(job)
+                    finished.add(job.index)
 
-                        # Skip
-                        else:
-                            print(str(e) + '. Skipping..')
+            feeder.join()
+            pipeline.close()
+        else:
+            for i, job in enumerate(jobs):
+                if pool is not None:
+                    pool.assign(job)
+                else:
+                    job.api = md.api
+                if prefetcher is not None:
+                    upcoming = jobs[i + 1:i + 1 + prefetcher.lookahead]
+                    for next_job in upcoming:
+                        if pool is not None:
+                            pool.assign(next_job)
+                        elif next_job.prefetch is None:
+                            next_job.api = md.api
+                    prefetcher.schedule(upcoming)
+
+                journal.set_state(item, keys[job.index], 'downloading')
+                while True:
+                    try:
+                        md.download_job(job)
+                        journal.set_state(item, keys[job.index], 'done')
+                        break
+                    except (ValueError, OSError, AssertionError) as e:
+                        if not handle_error(job, e):
+                            journal.set_state(item, keys[job.index], 'failed', str(e))
+                            break
 
-                # Progress of current track
+                # Keep using the last session for the following tracks
+                if pool is not None:
+                    pool.release(job)
+                else:
+                    md.api = job.api
                 cur += 1
-                print('=== {0}/{1} complete ({2:.0f}% done) ===\n'.format(
-                    cur, total, (cur / total) * 100))
+                print_progress()
+
+        if prefetcher is not None:
+            prefetcher.close()
+        journal.set_item_done(item, mt)
 
         # Progress of queue
-        print('> Download queue: {0}/{1} items complete ({2:.0f}% done) <\n'.
-            format(cm, len(media_to_download), (cm / len(media_to_download)) * 100))
+        if total_items:
+            print('> Download queue: {0}/{1} items complete ({2:.0f}% done) <\n'.
+                format(cm, total_items, (cm / total_items) * 100))
+        else:
+            print('> Download queue: {0} items complete <\n'.format(cm))
+
+    resolver.close()
 
     print('> All downloads completed. <')
+    journal.finish()
 
     # since oauth sessions can change while downloads are happening if the token gets refreshed
+    TidalApi.refresher.stop()
     RSF._save()
 
 
@@ -0,0 +1,67 @@
+import threading
+
+# Lyrics of this many tracks are fetched at once, see "lyrics_workers" in settings.py
+LYRICS_WORKERS = 4
+
+
+class AlbumContext(object):
+    '''
+    Metadata of a release which is shared by all of its tracks
+
+    The album, its credits and the lyrics of its tracks are fetched once and only when the first
+    track needs them. Once a track asks for its lyrics, the lyrics of the other tracks which will be
+    downloaded (see add_tracks) are fetched in the background on executor.
+    '''
+
+    def __init__(self, api, album_id, executor, album_info=None, track_ids=None):
+        self.api = api
+        self.album_id = album_id
+        self.executor = executor
+        self.album_info = album_info
+        self.track_ids = list(track_ids) if track_ids else []
+
+        self.credits = None
+        self.lyrics = {}  # track id -> future of the lyrics response
+        self.prefetched = set()  # ids of tracks whose lyrics were fetched before they asked for them
+        self.lock = threading.Lock()
+        self.album_lock = threading.Lock()
+        self.credits_lock = threading.Lock()
+
+    def add_tracks(self, track_ids):
+        with self.lock:
+            self.track_ids.extend(i for i in track_ids if i not in self.track_ids)
+
+    def album(self):
+        with self.album_lock:
+            if self.album_info is None:
+                self.album_info = self.api.get_album(self.album_id)
+            return self.album_info
+
+    def track_credits(self, track_id):
+        '''
+        Returns the credits list of a track of this album, None if there are none
+        '''
+        with self.credits_lock:
+            if self.credits is None:
+                album_credits = self.api.get_credits(str(self.album_id))
+                self.credits = {item['item']['id']: item['credits'] for item in album_credits['items']
+                                if 'item' in item and 'credits' in item}
+            return self.credits.get(track_id)
+
+    def track_lyrics(self, track_id):
+        '''
+        Returns the lyrics response of a track, on the first call the lyrics of the other tracks are fetched too
+        '''
+        with self.lock:
+            future = self.lyrics.get(track_id)
+            # A failed prefetch is tried again once the track gets to it
+            if future is None or (track_id in self.prefetched and future.done() and future.exception() is not None):
+                future = self.lyrics[track_id] = self.executor.submit(self.api.get_lyrics, track_id)
+            self.prefetched.discard(track_id)
+
+            for i in self.track_ids:
+                if i not in self.lyrics:
+                    self.lyrics[i] = self.executor.submit(self.api.get_lyrics, i)
+                    self.prefetched.add(i)
+
+        return future.result()
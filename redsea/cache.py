@@ -0,0 +1,208 @@
+import copy
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    '''
+    Thread-safe in-memory LRU cache for API responses
+
+    Every entry has its own time to live, expired entries are dropped on access and the least
+    recently used entry is evicted once max_entries is reached. Values are copied in and out,
+    so callers can modify what they get without changing the cached response.
+
+    An optional store (e.g. SqliteCache) is used as a second level which outlives the process.
+    '''
+
+    def __init__(self, max_entries=1024, store=None):
+        self.max_entries = max_entries
+        self.store = store
+        self.enabled = True
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Returns the cached value for key or None if it is missing or expired
+        '''
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None:
+                self._remember(key, entry[0], entry[1])
+
+        if entry is None:
+            return None
+        return copy.deepcopy(entry[1])
+
+    def _remember(self, key, expires, value):
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def set(self, key, value, ttl):
+        if not self.enabled or ttl <= 0:
+            return
+
+        value = copy.deepcopy(value)
+        self._remember(key, time.time() + ttl, value)
+        if self.store is not None:
+            self.store.set(key, value, ttl)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SqliteCache(object):
+    '''
+    Persistent store for API responses in a SQLite database, shared across runs
+
+    Entries expire after their time to live. Once the stored responses exceed max_bytes,
+    the least recently used quarter is evicted. Entries created before refresh_before are ignored,
+    which forces a refresh of everything requested in this run.
+    '''
+
+    def __init__(self, db_path, max_bytes=128 * 1024 ** 2, refresh_before=None):
+        self.max_bytes = max_bytes
+        self.refresh_before = refresh_before
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, '
+                              'created REAL, expires REAL, accessed REAL, size INTEGER)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self.conn.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+            self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, key):
+        '''
+        Returns (expires, value) for key or None if it is missing or expired
+        '''
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT value, created, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            value, created, expires = row
+            if expires < now or (self.refresh_before is not None and created < self.refresh_before):
+                return None
+
+            self.conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        return expires, json.loads(value)
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        value = json.dumps(value)
+        with self.lock, self.conn:
+            # A replaced entry no longer counts towards the size
+            row = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, value, now, now + ttl, now, len(value)))
+            self.size += len(value) - (row[0] if row else 0)
+
+            if self.size > self.max_bytes:
+                # The entry which was just written is kept
+                self.conn.execute('DELETE FROM responses WHERE expires < ? AND key != ?', (now, key))
+                count = self.conn.execute('SELECT COUNT(*) FROM responses WHERE key != ?', (key,)).fetchone()[0]
+                self.conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses WHERE key != ? '
+                                  'ORDER BY accessed LIMIT ?)', (key, max(1, count // 4)))
+                self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM responses')
+            self.size = 0
+
+
+class ArtworkCache(object):
+    '''
+    Keeps album covers in memory so they are only downloaded once per release
+
+    Covers are stored by the SHA-1 of their content, releases with the same cover share the bytes.
+    Only the covers and iTunes artwork URLs of the last max_albums releases are kept. album_lock() returns
+    a per-release lock, so concurrent tracks of a release wait for the first download instead of starting
+    their own.
+    '''
+
+    def __init__(self, max_albums=8):
+        self.max_albums = max_albums
+        self.albums = OrderedDict()  # album key -> digest, None if there is no cover
+        self.blobs = {}  # digest -> cover bytes
+        self.lookups = OrderedDict()  # album id -> iTunes artwork URL, None if iTunes has no match
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def album_lock(self, key):
+        with self.lock:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+            return self.locks[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.albums
+
+    def get(self, key):
+        with self.lock:
+            digest = self.albums.get(key)
+            return self.blobs.get(digest) if digest else None
+
+    def set(self, key, data):
+        with self.lock:
+            digest = hashlib.sha1(data).hexdigest() if data else None
+            if digest:
+                self.blobs[digest] = data
+            self.albums[key] = digest
+            self.albums.move_to_end(key)
+
+            while len(self.albums) > self.max_albums:
+                old_key, _ = self.albums.popitem(last=False)
+                self.locks.pop(old_key, None)
+
+            # Drop covers no release refers to anymore
+            used = set(self.albums.values())
+            for old_digest in [d for d in self.blobs if d not in used]:
+                del self.blobs[old_digest]
+
+    def get_lookup(self, album_id):
+        '''
+        Returns (True, URL) if the iTunes artwork of a release was looked up already, else (False, None)
+        '''
+        with self.lock:
+            if album_id not in self.lookups:
+                return False, None
+            return True, self.lookups[album_id]
+
+    def set_lookup(self, album_id, url):
+        with self.lock:
+            self.lookups[album_id] = url
+            self.lookups.move_to_end(album_id)
+            while len(self.lookups) > self.max_albums:
+                self.lookups.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.albums.clear()
+            self.blobs.clear()
+            self.lookups.clear()
+            self.locks.clear()
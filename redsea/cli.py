@@ -1,5 +1,6 @@
 import argparse
 import re
+import sys
 from urllib.parse import urlparse
 from os import path
 
@@ -30,6 +31,12 @@ def get_args():
         default='',
         help='Select a session/account to use. Defaults to the "default" session.')
 
+    parser.add_argument(
+        '--balance',
+        action='store_true',
+        default=False,
+        help='Spread the downloads over all sessions with the same region and type as the selected one')
+
     parser.add_argument(
         '-s',
         '--skip',
@@ -45,10 +52,40 @@ def get_args():
         help='Overwrite existing files [Default=skip]'
     )
 
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of tracks of the same album/playlist to download at once [Default=1]'
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        default=False,
+        help='Do not cache any API responses'
+    )
+
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        default=False,
+        help='Ignore API responses cached by previous runs and fetch them again'
+    )
+
     parser.add_argument(
         '--resumeon',
         type=int,
-        help='If ripping a single playlist, resume on the given track number.'
+        help='Deprecated, interrupted runs are resumed automatically. If ripping a single playlist, '
+             'resume on the given track number.'
+    )
+
+    parser.add_argument(
+        '--restart',
+        action='store_true',
+        default=False,
+        help='Start over instead of resuming an interrupted run with the same inputs'
     )
 
     parser.add_argument(
@@ -63,12 +100,15 @@ def get_args():
         action='store_const',
         const=True,
         default=False,
-        help='The URLs to download inside a .txt file with a single track/album/artist each line.'
+        help='The URLs to download inside a .txt file with a single track/album/artist each line, - reads them '
+             'from stdin. The file is read while downloading.'
     )
 
     args = parser.parse_args()
     if args.resumeon and args.resumeon <= 0:
         parser.error('--resumeon must be a positive integer')
+    if args.workers <= 0:
+        parser.error('--workers must be a positive integer')
 
     # Check if only URLs or a file exists
     if len(args.urls) > 1 and args.file:
@@ -78,51 +118,68 @@ def get_args():
 
 
 def parse_media_option(mo, is_file):
-    opts = []
+    return list(iter_media_option(mo, is_file))
+
+
+def iter_media_option(mo, is_file):
+    '''
+    Yields the media to download one by one, a file (or - for stdin) is read line by line while downloading
+    '''
     if is_file:
         file_name = str(mo[0])
-        mo = []
-        if path.exists(file_name):
-            file = open(file_name, 'r')
-            lines = file.readlines()
-            for line in lines:
-                mo.append(line.strip())
+        if file_name == '-':
+            mo = (line.strip() for line in sys.stdin)
+        elif path.exists(file_name):
+            mo = _read_lines(file_name)
         else:
             print("\t File " + file_name + " doesn't exist")
+            mo = []
     for m in mo:
-        if m.startswith('http'):
-            m = re.sub(r'tidal.com\/.{2}\/store\/', 'tidal.com/', m)
-            m = re.sub(r'tidal.com\/store\/', 'tidal.com/', m)
-            m = re.sub(r'tidal.com\/browse\/', 'tidal.com/', m)
-            url = urlparse(m)
-            components = url.path.split('/')
-            if not components or len(components) <= 2:
-                print('Invalid URL: ' + m)
-                exit()
-            if len(components) == 5:
-                type_ = components[3]
-                id_ = components[4]
-            else:
-                type_ = components[1]
-                id_ = components[2]
-            if type_ == 'album':
-                type_ = 'a'
-            elif type_ == 'track':
-                type_ = 't'
-            elif type_ == 'playlist':
-                type_ = 'p'
-            elif type_ == 'artist':
-                type_ = 'r'
-            elif type_ == 'video':
-                type_ = 'v'
-            opts.append({'type': type_, 'id': id_})
+        if not m:
             continue
-        elif ':' in m and '#' in m:
-            ci = m.index(':')
-            hi = m.find('#')
-            hi = len(m) if hi == -1 else hi
-            o = {'type': m[:ci], 'id': m[ci + 1:hi], 'index': m[hi + 1:]}
-            opts.append(o)
+        o = parse_media(m)
+        if o is not None:
+            yield o
+
+
+def _read_lines(file_name):
+    with open(file_name, 'r') as file:
+        for line in file:
+            yield line.strip()
+
+
+def parse_media(m):
+    if m.startswith('http'):
+        m = re.sub(r'tidal.com\/.{2}\/store\/', 'tidal.com/', m)
+        m = re.sub(r'tidal.com\/store\/', 'tidal.com/', m)
+        m = re.sub(r'tidal.com\/browse\/', 'tidal.com/', m)
+        url = urlparse(m)
+        components = url.path.split('/')
+        if not components or len(components) <= 2:
+            print('Invalid URL: ' + m)
+            exit()
+        if len(components) == 5:
+            type_ = components[3]
+            id_ = components[4]
         else:
-            print('Input "{}" does not appear to be a valid url.'.format(m))
-    return opts
+            type_ = components[1]
+            id_ = components[2]
+        if type_ == 'album':
+            type_ = 'a'
+        elif type_ == 'track':
+            type_ = 't'
+        elif type_ == 'playlist':
+            type_ = 'p'
+        elif type_ == 'artist':
+            type_ = 'r'
+        elif type_ == 'video':
+            type_ = 'v'
+        return {'type': type_, 'id': id_}
+    elif ':' in m and '#' in m:
+        ci = m.index(':')
+        hi = m.find('#')
+        hi = len(m) if hi == -1 else hi
+        return {'type': m[:ci], 'id': m[ci + 1:hi], 'index': m[hi + 1:]}
+    else:
+        print('Input "{}" does not appear to be a valid url.'.format(m))
+    return None
@@ -0,0 +1,34 @@
+import threading
+
+import requests
+from urllib3.util.retry import Retry
+
+from .ratelimit import LimitedAdapter, get_limiters
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_session(name, pool_size=10, account=None):
+    '''
+    Returns the process-wide requests session of a service (e.g. "tidal" or "cdn") and account, created on first use
+
+    All clients of a service share its connection pool, so connections are reused across queue items.
+    The pool keeps at least pool_size connections per host, asking for a larger pool enlarges it.
+    Requests are spaced by the rate limiters of the account, which also retry them after a 429.
+    '''
+    with _lock:
+        session, size = _sessions.get((name, account), (None, 0))
+        if session is None or size < pool_size:
+            if session is None:
+                session = requests.Session()
+
+            # 429s are handled by the rate limiters
+            retries = Retry(total=10,
+                            backoff_factor=0.4,
+                            status_forcelist=[500, 502, 503, 504])
+            limiters = get_limiters(account)
+            session.mount('http://', LimitedAdapter(limiters, max_retries=retries, pool_maxsize=pool_size))
+            session.mount('https://', LimitedAdapter(limiters, max_retries=retries, pool_maxsize=pool_size))
+            _sessions[(name, account)] = (session, pool_size)
+        return session
@@ -0,0 +1,119 @@
+import math
+import re
+import xml.etree.ElementTree as ET
+from urllib.parse import urljoin
+
+
+def _strip_namespace(element):
+    for el in element.iter():
+        if '}' in el.tag:
+            el.tag = el.tag.split('}', 1)[1]
+    return element
+
+
+def parse_duration(duration):
+    '''
+    Converts an ISO 8601 duration like "PT3M23.5S" to seconds
+    '''
+    match = re.match(r'^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?$', duration or '')
+    if not match:
+        return 0.0
+
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds or 0)
+
+
+def _base_url(base, element):
+    base_element = element.find('BaseURL')
+    if base_element is not None and base_element.text:
+        return urljoin(base, base_element.text.strip())
+    return base
+
+
+def _fill_template(template, representation, number=None, time=None):
+    def replace(match):
+        name, fmt = match.group(1), match.group(2)
+        value = {
+            'RepresentationID': representation.get('id'),
+            'Bandwidth': representation.get('bandwidth'),
+            'Number': number,
+            'Time': time
+        }[name]
+        if fmt:
+            return ('%' + fmt[1:]) % int(value)
+        return str(value)
+
+    url = re.sub(r'\$(RepresentationID|Bandwidth|Number|Time)(%0\d+d)?\$', replace, template)
+    return url.replace('$$', '$')
+
+
+def _segment_urls(template, representation, base, period_duration):
+    start_number = int(template.get('startNumber', 1))
+    media = template.get('media')
+
+    urls = []
+    initialization = template.get('initialization')
+    if initialization:
+        urls.append(urljoin(base, _fill_template(initialization, representation)))
+
+    timeline = template.find('SegmentTimeline')
+    if timeline is not None:
+        # Every S element stands for 1 + r segments of duration d
+        number = start_number
+        time = 0
+        for s in timeline.findall('S'):
+            if s.get('t') is not None:
+                time = int(s.get('t'))
+            duration = int(s.get('d'))
+            for _ in range(int(s.get('r', 0)) + 1):
+                urls.append(urljoin(base, _fill_template(media, representation, number, time)))
+                number += 1
+                time += duration
+    else:
+        # Fixed segment duration, the count follows from the presentation duration
+        timescale = int(template.get('timescale', 1))
+        count = math.ceil(period_duration * timescale / int(template.get('duration')))
+        for number in range(start_number, start_number + count):
+            urls.append(urljoin(base, _fill_template(media, representation, number)))
+
+    return urls
+
+
+def parse_mpd(manifest, base=''):
+    '''
+    Parses an MPEG-DASH manifest using SegmentTemplate addressing
+
+    Returns a dict of the representation with the highest bandwidth containing
+    its codecs, mimeType, bandwidth and the urls of all segments, starting with the initialization segment
+    '''
+    mpd = _strip_namespace(ET.fromstring(manifest))
+    base = _base_url(base, mpd)
+    duration = parse_duration(mpd.get('mediaPresentationDuration'))
+
+    streams = []
+    for period in mpd.findall('Period'):
+        period_base = _base_url(base, period)
+        period_duration = parse_duration(period.get('duration')) or duration
+
+        for adaptation_set in period.findall('AdaptationSet'):
+            set_base = _base_url(period_base, adaptation_set)
+            for representation in adaptation_set.findall('Representation'):
+                # Attributes and the SegmentTemplate may be set on the AdaptationSet instead
+                template = representation.find('SegmentTemplate')
+                if template is None:
+                    template = adaptation_set.find('SegmentTemplate')
+                if template is None:
+                    continue
+
+                streams.append({
+                    'codecs': representation.get('codecs', adaptation_set.get('codecs')),
+                    'mimeType': representation.get('mimeType', adaptation_set.get('mimeType')),
+                    'bandwidth': int(representation.get('bandwidth', 0)),
+                    'urls': _segment_urls(template, representation, _base_url(set_base, representation),
+                                          period_duration)
+                })
+
+    if not streams:
+        raise ValueError('No downloadable stream found in DASH manifest')
+
+    return max(streams, key=lambda stream: stream['bandwidth'])
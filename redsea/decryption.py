@@ -35,14 +35,30 @@ def decrypt_security_token(security_token):
     return key, nonce
 
 
+def stream_decryptor(key, nonce, offset=0):
+    '''
+    Returns an AES-CTR decryptor for an encrypted MQA stream given the key and nonce
+
+    The decryptor keeps its counter between calls, so the stream can be decrypted chunk by chunk.
+    offset is the byte position in the stream where decryption starts, e.g. when resuming a download
+    '''
+
+    # Every 16 byte block has its own counter value, skip the blocks before offset
+    counter = Counter.new(64, prefix=nonce, initial_value=offset // 16)
+    decryptor = AES.new(key, AES.MODE_CTR, counter=counter)
+
+    # Discard the key stream of the bytes before offset inside the first block
+    decryptor.decrypt(bytes(offset % 16))
+    return decryptor
+
+
 def decrypt_file(file, key, nonce):
     '''
     Decrypts an encrypted MQA file given the file, key and nonce
     '''
 
     # Initialize counter and file decryptor
-    counter = Counter.new(64, prefix=nonce, initial_value=0)
-    decryptor = AES.new(key, AES.MODE_CTR, counter=counter)
+    decryptor = stream_decryptor(key, nonce)
 
     # Open and decrypt
     with open(file, 'rb') as eflac:
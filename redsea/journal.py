@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+# Digests of finished items are read ahead from the journal at most this many items before they are checked
+PREFIX_WINDOW = 4096
+
+
+def _digest(media):
+    return zlib.crc32(json.dumps(media, sort_keys=True).encode('utf-8'))
+
+
+class QueueJournal(object):
+    '''
+    Append-only journal of a download queue, used to resume an interrupted run
+
+    Every line is a JSON record: the resolved tracks of a queue item, the state of a track
+    (downloading, done or failed with a reason) or a finished queue item. A run with the same
+    inputs replays the journal and continues where the previous run stopped, without resolving
+    the items again. The journal is deleted once the whole queue is finished.
+
+    Only the file offsets of resolved items and the states of unfinished items are kept in memory, and
+    records are only trusted if the queue item at their position is still the same. Finished items are kept
+    as the number of items which are all finished, plus the few finished items after the first unfinished one.
+    The digests of the finished items are read from the journal again while the queue is iterated, so a
+    changed input (e.g. another stdin queue) is not skipped.
+    '''
+
+    def __init__(self, journal_path):
+        self.path = journal_path
+        self.resolved = {}  # item -> (offset of the record, digest of the queue item)
+        self.states = {}  # (item, key) -> state, only for unfinished items
+        self.done_upto = 0  # All items before this one are finished
+        self.done_items = {}  # item -> digest of the queue item, only finished items after done_upto
+        self.lock = threading.Lock()
+
+        if os.path.isfile(journal_path):
+            self._replay()
+
+        # Finished items of previous runs, their digests are read ahead from the journal when they are checked
+        self.replayed_upto = self.done_upto
+        self.reader = open(journal_path, 'rb') if self.replayed_upto else None
+        self.prefix = {}  # item -> digest, finished items of previous runs which were read ahead
+        self.checked = 0
+        self.read_lock = threading.Lock()
+
+        # Whether an interrupted run is continued
+        self.resuming = bool(self.resolved or self.done_upto or self.done_items)
+        self.file = open(journal_path, 'ab')
+        if self.file.tell() > 0:
+            # Start a new line after an incomplete last record
+            with open(journal_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._append_line(b'')
+
+    @classmethod
+    def for_queue(cls, folder, preset_name, queue_key, restart=False):
+        '''
+        Opens the journal of a queue, the file name is derived from the preset and queue_key,
+        which is the list of queue items or the name of the input file
+
+        restart deletes the journal of an interrupted run first
+        '''
+        os.makedirs(folder, exist_ok=True)
+        key = json.dumps([preset_name, queue_key], sort_keys=True)
+        journal_path = os.path.join(folder, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.jsonl')
+        if restart and os.path.isfile(journal_path):
+            os.remove(journal_path)
+        return cls(journal_path)
+
+    def _replay(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete if the previous run was killed while writing it
+                    continue
+
+                event = record['event']
+                item = record['item']
+                if event == 'resolved':
+                    self.resolved[item] = (offset, record['digest'])
+                elif event == 'track':
+                    self.states[(item, record['key'])] = record['state']
+                elif event == 'item_done':
+                    self._forget(item)
+                    self._mark_done(item, record['digest'])
+
+    def _recorded_digest(self, item):
+        # The journal is read forward only, items which were checked long ago are not kept
+        with self.read_lock:
+            while item not in self.prefix and self.reader is not None:
+                line = self.reader.readline()
+                if not line:
+                    self.reader.close()
+                    self.reader = None
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record['event'] == 'item_done' and record['item'] < self.replayed_upto:
+                    self.prefix[record['item']] = record['digest']
+
+            digest = self.prefix.get(item)
+            self.checked = max(self.checked, item)
+            if len(self.prefix) > 2 * PREFIX_WINDOW:
+                self.prefix = {i: d for i, d in self.prefix.items() if i >= self.checked - PREFIX_WINDOW}
+            return digest
+
+    def _mark_done(self, item, digest):
+        if item == self.done_upto:
+            self.done_upto += 1
+            while self.done_upto in self.done_items:
+                del self.done_items[self.done_upto]
+                self.done_upto += 1
+        elif item > self.done_upto:
+            self.done_items[item] = digest
+
+    def _forget(self, item):
+        self.resolved.pop(item, None)
+        for key in [key for key in self.states if key[0] == item]:
+            del self.states[key]
+
+    def _append_line(self, line):
+        with self.lock:
+            offset = self.file.tell()
+            self.file.write(line + b'\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return offset
+
+    def _append(self, record):
+        return self._append_line(json.dumps(record).encode('utf-8'))
+
+    def is_done(self, item, media):
+        if item < self.replayed_upto:
+            return self._recorded_digest(item) == _digest(media)
+        return item < self.done_upto or self.done_items.get(item) == _digest(media)
+
+    def is_resolved(self, item, media):
+        return item in self.resolved and self.resolved[item][1] == _digest(media)
+
+    def get_resolved(self, item, media):
+        '''
+        Returns the data stored by set_resolved for the queue item, or None
+        '''
+        if not self.is_resolved(item, media):
+            return None
+        with self.lock, open(self.path, 'rb') as f:
+            f.seek(self.resolved[item][0])
+            return json.loads(f.readline())['data']
+
+    def set_resolved(self, item, media, data):
+        digest = _digest(media)
+        offset = self._append({'event': 'resolved', 'item': item, 'digest': digest, 'data': data})
+        self.resolved[item] = (offset, digest)
+
+    def set_state(self, item, key, state, reason=None):
+        self.states[(item, key)] = state
+        self._append({'event': 'track', 'item': item, 'key': key, 'state': state, 'reason': reason})
+
+    def state(self, item, media, key):
+        # States of a changed queue item at the same position are ignored
+        if not self.is_resolved(item, media):
+            return None
+        return self.states.get((item, key))
+
+    def set_item_done(self, item, media, reason=None):
+        '''
+        Marks a queue item as finished, reason tells why it was skipped instead
+        '''
+        digest = _digest(media)
+        self._forget(item)
+        self._mark_done(item, digest)
+        self._append({'event': 'item_done', 'item': item, 'digest': digest, 'reason': reason})
+
+    def finish(self):
+        '''
+        Deletes the journal, the queue was downloaded completely
+        '''
+        self.file.close()
+        if self.reader is not None:
+            self.reader.close()
+        os.remove(self.path)
@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from mutagen.flac import FLAC
+from mutagen.mp4 import MP4
+
+AUDIO_EXTENSIONS = ('.flac', '.m4a')
+
+
+def _first(tags, key):
+    values = tags.get(key) if tags is not None else None
+    if not values:
+        return None
+    value = values[0]
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return str(value)
+
+
+def _track_number(value):
+    # FLAC stores e.g. "01" or "01/12"
+    try:
+        return int(str(value).split('/')[0])
+    except (TypeError, ValueError):
+        return None
+
+
+def read_tags(file_path):
+    '''
+    Reads the tags redsea writes (ISRC, UPC, track number and album) and guesses the Tidal quality
+
+    Runs in a worker process of a library scan, returns None if the file can not be read
+    '''
+    try:
+        if file_path.lower().endswith('.flac'):
+            audio = FLAC(file_path)
+            tags = audio.tags
+            return {
+                'isrc': _first(tags, 'isrc'),
+                'upc': _first(tags, 'upc'),
+                'album': _first(tags, 'album'),
+                'tracknumber': _track_number(_first(tags, 'tracknumber')),
+                'quality': 'HI_RES' if audio.info.bits_per_sample > 16 else 'LOSSLESS'
+            }
+
+        audio = MP4(file_path)
+        tags = audio.tags
+        trkn = tags.get('trkn') if tags is not None else None
+        codec = getattr(audio.info, 'codec', '')
+        if codec == 'alac':
+            quality = 'HI_RES' if getattr(audio.info, 'bits_per_sample', 16) > 16 else 'LOSSLESS'
+        elif codec.startswith('mp4a'):
+            quality = 'HIGH' if audio.info.bitrate >= 256000 else 'LOW'
+        else:
+            # Dolby Atmos and other codecs can not be told apart by their tags
+            quality = None
+        return {
+            'isrc': _first(tags, '----:com.apple.itunes:ISRC'),
+            'upc': _first(tags, '----:com.apple.itunes:UPC'),
+            'album': _first(tags, '\xa9alb'),
+            'tracknumber': trkn[0][0] if trkn else None,
+            'quality': quality
+        }
+    except Exception:
+        return None
+
+
+class LibraryIndex(object):
+    '''
+    Persistent index of the tracks which are already on disk, stored in a SQLite database
+
+    Every file is recorded with its Tidal track id (if known), ISRC, UPC, album, track number, quality,
+    size and mtime. root is the download path the file was saved under, so a track is only skipped
+    when it would be saved below the same path again.
+    '''
+
+    COLUMNS = ('path', 'track_id', 'isrc', 'upc', 'album', 'tracknumber', 'quality', 'size', 'mtime', 'root', 'added')
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, track_id INTEGER, isrc TEXT, '
+                              'upc TEXT, album TEXT, tracknumber INTEGER, quality TEXT, size INTEGER, mtime REAL, '
+                              'root TEXT, added REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS tracks_track_id ON tracks (track_id)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS tracks_isrc ON tracks (isrc)')
+
+    def entries(self, root):
+        '''
+        Returns {path: (size, mtime)} of all files recorded below root
+        '''
+        root = os.path.abspath(root)
+        with self.lock:
+            rows = self.conn.execute('SELECT path, size, mtime FROM tracks WHERE path LIKE ? ESCAPE ?',
+                                     (root.replace('!', '!!').replace('%', '!%').replace('_', '!_') + os.sep + '%',
+                                      '!')).fetchall()
+        return {file_path: (size, mtime) for file_path, size, mtime in rows}
+
+    def scan(self, root, workers=None):
+        '''
+        Walks root and records all FLAC and M4A files with the tags redsea writes
+
+        Tags are read in a pool of worker processes. Files which are recorded with the same size and mtime
+        already are not read again, entries of deleted files are dropped. Returns the number of read files.
+        '''
+        known = self.entries(root)
+
+        files = []
+        for dir_path, _, file_names in os.walk(root):
+            for file_name in file_names:
+                if file_name.lower().endswith(AUDIO_EXTENSIONS):
+                    files.append(os.path.abspath(os.path.join(dir_path, file_name)))
+
+        for file_path in set(known) - set(files):
+            self.remove(file_path)
+
+        changed = []
+        for file_path in files:
+            stat = os.stat(file_path)
+            if known.get(file_path) != (stat.st_size, stat.st_mtime):
+                changed.append(file_path)
+
+        print('Found {} files, {} new or changed'.format(len(files), len(changed)))
+        if not changed:
+            return 0
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(read_tags, changed, chunksize=16)
+            for i, (file_path, tags) in enumerate(zip(changed, results)):
+                print('Reading tags {}/{}'.format(i + 1, len(changed)), end='\r')
+                if tags is None:
+                    print('\nCould not read tags of ' + file_path)
+                    continue
+
+                # Track id and download path are only known for files redsea downloaded itself
+                entry = self.get(file_path)
+                if entry:
+                    self.add(file_path, entry['root'], track_id=entry['track_id'], **tags)
+                else:
+                    self.add(file_path, root, **tags)
+        print()
+
+        return len(changed)
+
+    def add(self, file_path, root, track_id=None, isrc=None, upc=None, album=None, tracknumber=None, quality=None):
+        '''
+        Records a file which exists on disk, replaces an older entry of the same path
+        '''
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (file_path, track_id, isrc, upc, album, tracknumber, quality, stat.st_size,
+                               stat.st_mtime, os.path.abspath(root), time.time()))
+
+    def remove(self, file_path):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM tracks WHERE path = ?', (os.path.abspath(file_path),))
+
+    def get(self, file_path):
+        '''
+        Returns the entry of a path as a dict or None
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT * FROM tracks WHERE path = ?', (os.path.abspath(file_path),)).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def find(self, root, track_id, isrc=None, album=None, qualities=None):
+        '''
+        Returns the path of an existing file of a track below root, or None
+
+        Files without a track id (e.g. found by a library scan) are matched by ISRC and album title.
+        Entries whose file was deleted or changed size are dropped.
+        '''
+        with self.lock:
+            rows = self.conn.execute('SELECT path, quality, size FROM tracks WHERE root = ? AND (track_id = ? OR '
+                                     '(track_id IS NULL AND isrc = ? AND album = ?))',
+                                     (os.path.abspath(root), track_id, isrc, album)).fetchall()
+
+        for file_path, quality, size in rows:
+            if qualities is not None and quality not in qualities:
+                continue
+
+            try:
+                if os.path.getsize(file_path) == size:
+                    return file_path
+            except OSError:
+                pass
+            self.remove(file_path)
+
+        return None
+
+    def find_isrc(self, isrc, quality):
+        '''
+        Returns the entries of existing files of a recording in a quality, anywhere in the library
+        '''
+        with self.lock:
+            rows = self.conn.execute('SELECT * FROM tracks WHERE isrc = ? AND quality = ?', (isrc, quality)).fetchall()
+
+        entries = []
+        for row in rows:
+            entry = dict(zip(self.COLUMNS, row))
+            try:
+                if os.path.getsize(entry['path']) == entry['size']:
+                    entries.append(entry)
+                    continue
+            except OSError:
+                pass
+            self.remove(entry['path'])
+        return entries
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -3,20 +3,32 @@ import json
 import os
 import os.path as path
 import re
+import shutil
 import base64
 import ffmpeg
-import shutil
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from tqdm import tqdm
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
 
-from .decryption import decrypt_file, decrypt_security_token
+from .album import AlbumContext, LYRICS_WORKERS
+from .cache import ArtworkCache
+from .clients import get_session
+from .dash import parse_mpd
+from .decryption import decrypt_security_token, stream_decryptor
 from .tagger import FeaturingFormat
 from .tidal_api import TidalApi, TidalRequestError, technical_names
 from deezer.deezer import Deezer, APIError
-from .videodownloader import download_stream, download_file, tags
+from .videodownloader import download_stream, tags
+from .pipeline import Pipeline, Stage
+from .prefetch import playback_expiry, take_prefetched
+from .segments import fetch_segments
+
+CHUNK_SIZE = 64 * 1024
 
 
 def _mkdir_p(path):
@@ -30,6 +42,46 @@ def _mkdir_p(path):
             raise
 
 
+class DownloadJob(object):
+    '''
+    State of a single track or video while it passes through the download stages
+    '''
+
+    def __init__(self, api, track_info, album_info=None, overwrite=False, track_num=None, index=0, album=None):
+        self.api = api
+        self.track_info = track_info
+        self.album_info = album_info
+        # AlbumContext shared with the other tracks of the release
+        self.album = album
+        self.overwrite = overwrite
+        self.track_num = track_num
+        self.index = index
+
+        self.video = False
+        self.drm = False
+        self.dash = False
+        self.album_location = None
+        self.disc_location = None
+        self.track_file = None
+        self.track_path = None
+        self.playback_info = None
+        self.manifest = None
+        self.url = None
+        self.ftype = None
+        self.temp_file = None
+        self.segments_location = None
+        self.artwork = None
+
+        # Existing file of the same recording from another release, copied instead of downloaded
+        self.source = None
+        # Future of the playback info fetched ahead by a Prefetcher
+        self.prefetch = None
+        # Set by the Pipeline when a stage fails
+        self.error = None
+        # Used by the caller to brute force through sessions
+        self.session_gen = None
+
+
 class MediaDownloader(object):
 
     def __init__(self, api, options, tagger=None):
@@ -37,45 +89,253 @@ class MediaDownloader(object):
         self.opts = options
         self.tm = tagger
 
-        # Deezer API
-        if 'genre_language' in self.opts:
-            self.dz = Deezer(language=self.opts['genre_language'])
-        else:
-            self.dz = Deezer()
+        # Deezer API, created on first use as its constructor makes a request
+        self._dz = None
+
+        # Album covers and metadata, shared by all tracks of a release
+        self.artwork = ArtworkCache()
+        self.albums = OrderedDict()
+        self.albums_lock = threading.Lock()
+        self.lyrics_executor = None
+
+        # LibraryIndex of the downloaded tracks, set by the caller
+        self.library = None
+
+        # Segmented downloads use several connections per file
+        connections = self.opts['download_connections'] if 'download_connections' in self.opts else 1
+        self.pool_size = max(10, connections, self._segment_workers())
+
+    @property
+    def session(self):
+        return self.cdn_session(self.api)
+
+    def cdn_session(self, api):
+        '''
+        Returns the download session of the account of api, downloads count against its rate budget
+        '''
+        return get_session('cdn', pool_size=self.pool_size, account=getattr(api.session, 'user_id', None))
+
+    @property
+    def dz(self):
+        if self._dz is None:
+            if 'genre_language' in self.opts:
+                self._dz = Deezer(language=self.opts['genre_language'])
+            else:
+                self._dz = Deezer()
+        return self._dz
+
+    @staticmethod
+    def _load_part_info(where, key_id):
+        '''
+        Returns the stored info of a partial download of where, or None if there is none for this stream
+        '''
+        part_file = where + '.part'
+        try:
+            with open(part_file + '.json', 'r') as f:
+                part_info = json.load(f)
+        except (OSError, ValueError):
+            return None
 
-        self.session = requests.Session()
-        retries = Retry(total=10,
-                        backoff_factor=0.4,
-                        status_forcelist=[429, 500, 502, 503, 504])
+        if not path.isfile(part_file) or part_info['keyId'] != key_id:
+            return None
+        return part_info
 
-        self.session.mount('http://', HTTPAdapter(max_retries=retries))
-        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+    @staticmethod
+    def _save_part_info(where, part_info):
+        with open(where + '.part.json', 'w') as f:
+            json.dump(part_info, f)
+
+    @staticmethod
+    def _finish_part(where):
+        # Only complete files are moved into place
+        os.replace(where + '.part', where)
+        os.remove(where + '.part.json')
+        return where
+
+    def _dl_url(self, url, where, key=None, nonce=None, key_id=None, session=None):
+        '''
+        Downloads url to where, decrypting it on the fly if key and nonce are given
+
+        The file is written to where.part and only renamed to where once it is complete. The expected size
+        and key_id are stored next to it in where.part.json, so an interrupted download is resumed
+        with a Range request on the next run. If "download_connections" is set, the file is split into
+        byte ranges which are fetched concurrently.
+        '''
+        session = session or self.session
+        part_file = where + '.part'
+        part_info = self._load_part_info(where, key_id)
+
+        connections = self.opts['download_connections'] if 'download_connections' in self.opts else 1
+        r = None
+        if part_info and 'segments' in part_info:
+            return self._dl_url_segmented(url, where, max(connections, 1), key, nonce, key_id, part_info, session)
+        elif part_info is None and connections > 1:
+            # Ask for the first byte to learn the size and whether ranges are supported
+            r = session.get(url, stream=True, verify=False, headers={'Range': 'bytes=0-0'})
+            content_range = r.headers.get('content-range', '')
+            if r.status_code == 206 and '/' in content_range and not content_range.endswith('/*') and \
+                    int(content_range.split('/')[-1]) > 0:
+                r.close()
+                return self._dl_url_segmented(url, where, connections, key, nonce, key_id, session=session,
+                                              total=int(content_range.split('/')[-1]))
+
+            # The server ignored the range, its full response is downloaded by a single stream below
+            if r.status_code != 200:
+                r.close()
+                r = None
+
+        # Check if there is a matching partial download to resume
+        offset = 0
+        if part_info:
+            if path.getsize(part_file) == part_info['total']:
+                # The previous run stopped right before moving the complete file into place
+                return self._finish_part(where)
+            if path.getsize(part_file) < part_info['total']:
+                offset = path.getsize(part_file)
+
+        if r is None:
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else None
+            r = session.get(url, stream=True, verify=False, headers=headers)
+
+        # Start from the beginning if the server ignored the range or the file changed
+        if offset > 0 and (r.status_code != 206 or
+                           not r.headers.get('content-range', '').endswith('/{}'.format(part_info['total']))):
+            r.close()
+            offset = 0
+            r = session.get(url, stream=True, verify=False)
 
-    def _dl_url(self, url, where):
-        r = self.session.get(url, stream=True, verify=False)
         try:
-            total = int(r.headers['content-length'])
+            total = offset + int(r.headers['content-length'])
         except KeyError:
             return False
-        with open(where, 'wb') as f:
-            with tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, miniters=1,
+
+        if offset > 0:
+            print('\tResuming download at {0:.2f}MB'.format(offset / 1024 ** 2))
+        else:
+            self._save_part_info(where, {'total': total, 'keyId': key_id})
+
+        # Decrypt each chunk as it arrives if the stream is encrypted
+        decryptor = stream_decryptor(key, nonce, offset) if key is not None else None
+
+        with open(part_file, 'ab' if offset > 0 else 'wb') as f:
+            with tqdm(total=total, initial=offset, unit='B', unit_scale=True, unit_divisor=1024, miniters=1,
                       bar_format='        {l_bar}{bar}{r_bar}') as bar:
-                for chunk in r.iter_content(chunk_size=1024):
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
                     if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
+                        f.write(decryptor.decrypt(chunk) if decryptor else chunk)
                         bar.update(len(chunk))
             print()
-        return where
 
-    def _dl_picture(self, album_id, where):
-        if album_id is not None:
-            rc = self._dl_url(TidalApi.get_album_artwork_url(album_id), where)
-            if not rc:
-                return False
-            else:
-                return rc
+        if path.getsize(part_file) != total:
+            raise OSError('Download of {} is incomplete, it will be resumed on the next run'.format(where))
+
+        return self._finish_part(where)
+
+    def _dl_url_segmented(self, url, where, connections, key=None, nonce=None, key_id=None, part_info=None,
+                          session=None, total=None):
+        '''
+        Downloads url with several connections at once, each one writing its own byte range
+        into the preallocated where.part file. Finished ranges are stored in where.part.json.
+
+        Resumes the download of part_info, or starts a new one of total bytes
+        '''
+        session = session or self.session
+        part_file = where + '.part'
+
+        if part_info is None:
+            # Split into equal ranges aligned to the AES block size
+            size = -(-total // connections)
+            size += -size % 16
+            part_info = {
+                'total': total,
+                'keyId': key_id,
+                'segments': [[start, min(start + size, total) - 1, False] for start in range(0, total, size)]
+            }
+
+            with open(part_file, 'wb') as f:
+                f.truncate(total)
+            self._save_part_info(where, part_info)
         else:
-            return False
+            print('\tResuming segmented download')
+
+        total = part_info['total']
+        remaining = [segment for segment in part_info['segments'] if not segment[2]]
+        done = total - sum(end - start + 1 for start, end, _ in remaining)
+        lock = threading.Lock()
+
+        with tqdm(total=total, initial=done, unit='B', unit_scale=True, unit_divisor=1024, miniters=1,
+                  bar_format='        {l_bar}{bar}{r_bar}') as bar:
+            # Set when a range fails or the download is interrupted, the other ranges stop at their next chunk
+            stopped = threading.Event()
+
+            def fetch(segment):
+                if stopped.is_set():
+                    return
+                start, end, _ = segment
+                try:
+                    r = session.get(url, stream=True, verify=False,
+                                    headers={'Range': 'bytes={}-{}'.format(start, end)})
+                    try:
+                        if r.status_code != 206:
+                            raise OSError('Range request for {} failed with HTTP {}'.format(where, r.status_code))
+
+                        decryptor = stream_decryptor(key, nonce, start) if key is not None else None
+                        written = 0
+                        with open(part_file, 'r+b') as f:
+                            f.seek(start)
+                            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                                if stopped.is_set():
+                                    # Left unfinished in the part info, resumed on the next run
+                                    return
+                                if chunk:  # filter out keep-alive new chunks
+                                    f.write(decryptor.decrypt(chunk) if decryptor else chunk)
+                                    written += len(chunk)
+                                    with lock:
+                                        bar.update(len(chunk))
+                    finally:
+                        r.close()
+
+                    if written != end - start + 1:
+                        raise OSError('Download of {} is incomplete, it will be resumed on the next run'
+                                      .format(where))
+                except BaseException:
+                    stopped.set()
+                    raise
+
+                with lock:
+                    segment[2] = True
+                    self._save_part_info(where, part_info)
+
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                futures = [executor.submit(fetch, segment) for segment in remaining]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    # e.g. Ctrl-C, ranges which did not start yet are dropped
+                    stopped.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
+        print()
+
+        return self._finish_part(where)
+
+    def _segment_workers(self):
+        return self.opts['segment_workers'] if 'segment_workers' in self.opts else 8
+
+    def _dl_bytes(self, url):
+        r = self.session.get(url, verify=False)
+        r.raise_for_status()
+        return r.content
+
+    def _dl_picture(self, album_id):
+        if album_id is None:
+            return None
+        try:
+            return self._dl_bytes(TidalApi.get_album_artwork_url(album_id))
+        except requests.RequestException:
+            return None
 
     @staticmethod
     def _sanitise_name(name):
@@ -92,12 +352,14 @@ class MediaDownloader(object):
 
         return re.sub(r'[:]', ' - ', name)
 
-    def _normalise_info(self, track_info, album_info, use_album_artists=False):
-        info = {
-            k: self._sanitise_name(v)
-            for k, v in self.tm.tags(track_info, None, album_info).items()
-        }
+    def _normalise_info(self, track_info, album_info, use_album_artists=False, info=None):
+        if info is None:
+            info = {
+                k: self._sanitise_name(v)
+                for k, v in self.tm.tags(track_info, None, album_info).items()
+            }
         if len(album_info['artists']) > 1 and use_album_artists:
+            info = dict(info)
             self.featform = FeaturingFormat()
 
             artists = []
@@ -175,7 +437,147 @@ class MediaDownloader(object):
     def playlist_from_id(self, id):
         return self.api.get_playlist(id)
 
+    def album_context(self, album_id, album_info=None, track_ids=None):
+        '''
+        Returns the AlbumContext of a release, created on first use and shared by all of its tracks
+        '''
+        with self.albums_lock:
+            if album_id not in self.albums:
+                if self.lyrics_executor is None:
+                    workers = self.opts['lyrics_workers'] if 'lyrics_workers' in self.opts else LYRICS_WORKERS
+                    self.lyrics_executor = ThreadPoolExecutor(max_workers=max(1, workers),
+                                                              thread_name_prefix='lyrics')
+                self.albums[album_id] = AlbumContext(self.api, album_id, self.lyrics_executor, album_info, track_ids)
+                # Only keep the releases which are downloaded at the moment
+                while len(self.albums) > 16:
+                    self.albums.popitem(last=False)
+            self.albums.move_to_end(album_id)
+            return self.albums[album_id]
+
+    def _indexed(self, job):
+        '''
+        Returns the path of the job's track if the library index knows it is downloaded already
+        '''
+        track_info = job.track_info
+        if self.library is None or job.overwrite or 'type' in track_info:
+            return None
+        return self.library.find(self.opts['path'], track_info['id'], track_info['isrc'],
+                                 track_info['album']['title'], self.opts['quality'])
+
+    def _index_job(self, job, file_path):
+        if self.library is None:
+            return
+        track_info = job.track_info
+        self.library.add(file_path, self.opts['path'], track_id=track_info['id'], isrc=track_info['isrc'],
+                         upc=job.album_info['upc'], album=track_info['album']['title'],
+                         tracknumber=track_info['trackNumber'], quality=job.playback_info['audioQuality'])
+
+    def _find_duplicate(self, job):
+        '''
+        Returns (entry, ftype) of an indexed file of the same recording (ISRC) and quality, or None
+        '''
+        if self.library is None or 'dedup_isrc' not in self.opts or not self.opts['dedup_isrc']:
+            return None
+        if job.overwrite or not job.track_info['isrc']:
+            return None
+
+        # The file type after the conversion
+        ftype = 'm4a' if self.opts['convert_to_alac'] and job.ftype == 'flac' else job.ftype
+        for entry in self.library.find_isrc(job.track_info['isrc'], job.playback_info['audioQuality']):
+            if entry['path'].endswith('.' + ftype):
+                return entry, ftype
+        return None
+
+    @staticmethod
+    def _link(source, where):
+        '''
+        Hardlinks source to where, copies it if the file system does not support it (e.g. another drive)
+        '''
+        if path.isfile(where):
+            os.remove(where)
+        try:
+            os.link(source, where)
+        except OSError:
+            shutil.copyfile(source, where + '.part')
+            os.replace(where + '.part', where)
+
+    def prefetch_job(self, job):
+        '''
+        Fetches the playback info and album metadata of a job before it is downloaded, used by a Prefetcher
+        '''
+        api = job.api
+        track_info = job.track_info
+        if not track_info['allowStreaming'] or self._indexed(job):
+            return None
+
+        fetched = time.time()
+        if 'type' in track_info:
+            playback_info = api.get_video_stream_url(track_info['id'])
+        else:
+            playback_info = api.get_stream_url(track_info['id'], self.opts['quality'])
+
+            # Errors are reported when the stages fetch the metadata again
+            try:
+                album = job.album or self.album_context(track_info['album']['id'], job.album_info)
+                album.album()
+                album.track_credits(track_info['id'])
+                if 'save_lyrics_lrc' in self.opts and 'embed_lyrics' in self.opts:
+                    if self.opts['save_lyrics_lrc'] or self.opts['embed_lyrics']:
+                        album.track_lyrics(track_info['id'])
+            except Exception:
+                pass
+
+        return {
+            'api': api,
+            'playback_info': playback_info,
+            'expires': playback_expiry(playback_info, fetched)
+        }
+
     def download_media(self, track_info, album_info=None, overwrite=False, track_num=None):
+        job = DownloadJob(self.api, track_info, album_info, overwrite=overwrite, track_num=track_num)
+        return self.download_job(job)
+
+    def download_job(self, job):
+        '''
+        Runs all download stages for a single job, one after another
+        '''
+        try:
+            for _, stage in self.stages():
+                if stage(job) is None:
+                    return None
+            return job.album_location, job.temp_file
+
+        # Delete the not yet tagged file on keyboard interrupt, partial downloads stay as .part to be resumed
+        except KeyboardInterrupt:
+            if job.track_path and path.isfile(job.track_path):
+                print('Deleting unfinished file ' + str(job.track_path))
+                os.remove(job.track_path)
+            raise
+
+    def stages(self):
+        '''
+        Returns the download stages in order as (name, function) pairs
+        '''
+        return [
+            ('resolve', self._stage_resolve),
+            ('playback', self._stage_playback),
+            ('fetch', self._stage_fetch),
+            ('decrypt', self._stage_decrypt),
+            ('convert', self._stage_convert),
+            ('tag', self._stage_tag)
+        ]
+
+    def pipeline(self, stage_workers=None, queue_size=2):
+        '''
+        Creates a Pipeline running the download stages, stage_workers maps stage names to worker counts
+        '''
+        if stage_workers is None:
+            stage_workers = {}
+        return Pipeline([Stage(name, func, stage_workers.get(name, 1)) for name, func in self.stages()],
+                        queue_size=queue_size)
+
+    def _stage_resolve(self, job):
+        track_info = job.track_info
         track_id = track_info['id']
         assert track_info['allowStreaming'], 'Unable to download track {0}: not allowed to stream/download'.format(
             track_id)
@@ -184,8 +586,7 @@ class MediaDownloader(object):
 
         # Check if track is video
         if 'type' in track_info:
-            playback_info = self.api.get_video_stream_url(track_id)
-            url = playback_info['url']
+            job.video = True
 
             # Fallback if settings doesn't exist
             if 'resolution' not in self.opts:
@@ -197,18 +598,183 @@ class MediaDownloader(object):
                 self.opts['video_file_format'] = '{title}'
 
             # Make video locations
-            video_location = path.join(
+            job.album_location = path.join(
                 self.opts['path'], self.opts['video_folder_format'].format(**self._normalise_video(track_info))).strip()
-            video_file = self.opts['video_file_format'].format(**self._normalise_video(track_info))
-            _mkdir_p(video_location)
+            job.track_file = self.opts['video_file_format'].format(**self._normalise_video(track_info))
+            _mkdir_p(job.album_location)
+
+            job.track_path = os.path.join(job.album_location, job.track_file + '.mp4')
+            if path.isfile(job.track_path) and not job.overwrite:
+                print('\tFile {} already exists, skipping.'.format(job.track_path))
+                return None
+
+            return job
+
+        # Skip downloaded tracks before any request is made
+        existing = self._indexed(job)
+        if existing:
+            print('\tFile {} already exists, skipping.'.format(existing))
+            return None
+
+        if job.album is None:
+            job.album = self.album_context(track_info['album']['id'], job.album_info)
 
-            file_location = os.path.join(video_location, video_file + '.mp4')
-            if path.isfile(file_location) and not overwrite:
-                print('\tFile {} already exists, skipping.'.format(file_location))
+        if job.album_info is None:
+            print('\tGrabbing album info...')
+            tries = self.opts['tries']
+            for i in range(tries):
+                try:
+                    job.album_info = job.album.album()
+                    break
+                except Exception as e:
+                    print(e)
+                    print('\tGrabbing album info failed, retrying... ({}/{})'.format(i + 1, tries))
+                    if i + 1 == tries:
+                        raise
+        album_info = job.album_info
+
+        # create correct playlist numbering if track_num is present
+        if job.track_num:
+            if 'playlist_format' not in self.opts:
+                self.opts['playlist_format'] = "{playlistnumber} - {title}"
+
+            # ugly replace operation
+            playlist_format = self.opts['playlist_format'].replace('{playlistnumber}', str(job.track_num).zfill(2))
+            # Make locations
+            # path already includes the playlist name in this case
+            album_location = self.opts['path']
+            track_file = playlist_format.format(**self._normalise_info(track_info, album_info))
+        else:
+            # Make locations
+            info = self._normalise_info(track_info, album_info)
+            album_location = path.join(
+                self.opts['path'], self.opts['album_format'].format(
+                    **self._normalise_info(track_info, album_info, True, info))).strip()
+            track_file = self.opts['track_format'].format(**info)
+
+            # Make multi disc directories
+            if album_info['numberOfVolumes'] > 1:
+                disc_location = path.join(
+                    album_location,
+                    'CD{num}'.format(num=track_info['volumeNumber']))
+                job.disc_location = re.sub(r'\.+$', '', disc_location)
+                _mkdir_p(job.disc_location)
+
+        job.album_location = re.sub(r'\.+$', '', album_location)
+        if len(track_file) > 255:  # trim filename to be under OS limit (and account for file extension)
+            track_file = track_file[:250 - len(track_file)]
+        job.track_file = re.sub(r'\.+$', '', track_file)
+        _mkdir_p(job.album_location)
+
+        return job
+
+    def _stage_playback(self, job):
+        if job.video:
+            job.playback_info = take_prefetched(job) or job.api.get_video_stream_url(job.track_info['id'])
+            job.url = job.playback_info['url']
+            return job
+
+        # Attempt to get stream URL
+        # stream_data = self.get_stream_url(track_id, quality)
+
+        playback_info = take_prefetched(job) or job.api.get_stream_url(job.track_info['id'], self.opts['quality'])
+        job.playback_info = playback_info
+
+        manifest_unparsed = base64.b64decode(playback_info['manifest']).decode('UTF-8')
+        if 'ContentProtection' in manifest_unparsed:
+            job.drm = True
+            print("\tWarning: DRM has been detected. If you do not have the decryption key, do not use web login.")
+        elif 'manifestMimeType' in playback_info:
+            if playback_info['manifestMimeType'] == 'application/dash+xml':
+                job.dash = True
+
+        if job.drm or job.dash:
+            try:
+                job.manifest = parse_mpd(manifest_unparsed)
+            except (ValueError, KeyError, TypeError, ET.ParseError):
+                raise AssertionError(f'\tUnable to download track {playback_info["trackId"]} in '
+                                     f'{playback_info["audioQuality"]}!\n')
+
+        if job.dash:
+            # Detect codec
+            print('\tCodec: ', end='')
+            print(technical_names.get(job.manifest['codecs'], job.manifest['codecs']))
+
+            job.ftype = 'flac' if job.manifest['codecs'] == 'flac' else 'm4a'
+        elif not job.drm:
+            job.manifest = json.loads(manifest_unparsed)
+            # Detect codec
+            print('\tCodec: ', end='')
+            print(technical_names[job.manifest['codecs']])
+
+            job.url = job.manifest['urls'][0]
+            if job.url.find('.flac?') == -1:
+                if job.url.find('.m4a?') == -1:
+                    if job.url.find('.mp4?') == -1:
+                        job.ftype = ''
+                    else:
+                        job.ftype = 'm4a'
+                else:
+                    job.ftype = 'm4a'
+            else:
+                job.ftype = 'flac'
+        # ftype needs to be changed to work with audio codecs instead when with web auth
+        else:
+            job.ftype = 'flac'
+
+        if job.album_info['numberOfVolumes'] > 1 and not job.track_num:
+            job.track_path = path.join(job.disc_location, job.track_file + '.' + job.ftype)
+        else:
+            job.track_path = path.join(job.album_location, job.track_file + '.' + job.ftype)
+
+        if path.isfile(job.track_path) and not job.overwrite:
+            print('\tFile {} already exists, skipping.'.format(job.track_path))
+            # Next time the track is skipped without a request
+            self._index_job(job, job.track_path)
+            return None
+
+        # Reuse the same recording from another album or playlist folder instead of downloading it again
+        duplicate = self._find_duplicate(job)
+        if duplicate:
+            entry, ftype = duplicate
+            track_path = path.splitext(job.track_path)[0] + '.' + ftype
+            if path.isfile(track_path):
+                print('\tFile {} already exists, skipping.'.format(track_path))
+                self._index_job(job, track_path)
                 return None
 
+            if path.abspath(entry['path']) != path.abspath(track_path):
+                job.track_path = track_path
+                job.ftype = ftype
+                job.drm, job.dash = False, False
+
+                # Same track, so the tags would be the same as well
+                if entry['track_id'] == job.track_info['id']:
+                    print('\tLinking existing file {}'.format(entry['path']))
+                    self._link(entry['path'], job.track_path)
+                    self._index_job(job, job.track_path)
+                    return None
+
+                job.source = entry['path']
+
+        self.print_track_info(job.track_info, job.album_info)
+
+        return job
+
+    def _stage_fetch(self, job):
+        if job.source is not None:
+            # Another release of the recording, it is copied and tagged again
+            print('\tCopying existing file {}'.format(job.source))
+            shutil.copyfile(job.source, job.track_path + '.part')
+            self.tm.clear_tags(job.track_path + '.part', job.ftype)
+            os.replace(job.track_path + '.part', job.track_path)
+            job.temp_file = job.track_path
+            job.artwork = self._fetch_artwork(job)
+            return job
+
+        if job.video:
             # Get video credits
-            video_credits = self.credits_from_video(str(track_info['id']))
+            video_credits = job.api.get_video_credits(str(job.track_info['id']))
             credits_dict = {}
             if video_credits['totalNumberOfItems'] > 0:
                 for contributor in video_credits['items']:
@@ -232,312 +798,255 @@ class MediaDownloader(object):
                         if not self.opts['embed_credits']:
                             credits_dict = None
 
-            download_stream(video_location, video_file, url, self.opts['resolution'], track_info, credits_dict)
-
-        else:
-            if album_info is None:
-                print('\tGrabbing album info...')
-                tries = self.opts['tries']
-                for i in range(tries):
-                    try:
-                        album_info = self.api.get_album(track_info['album']['id'])
-                        break
-                    except Exception as e:
-                        print(e)
-                        print('\tGrabbing album info failed, retrying... ({}/{})'.format(i + 1, tries))
-                        if i + 1 == tries:
-                            raise
-
-            # create correct playlist numbering if track_num is present
-            if track_num:
-                if 'playlist_format' not in self.opts:
-                    self.opts['playlist_format'] = "{playlistnumber} - {title}"
-
-                # ugly replace operation
-                playlist_format = self.opts['playlist_format'].replace('{playlistnumber}', str(track_num).zfill(2))
-                # Make locations
-                # path already includes the playlist name in this case
-                album_location = self.opts['path']
-                track_file = playlist_format.format(**self._normalise_info(track_info, album_info))
-            else:
-                # Make locations
-                album_location = path.join(
-                    self.opts['path'], self.opts['album_format'].format(
-                        **self._normalise_info(track_info, album_info, True))).strip()
-                track_file = self.opts['track_format'].format(**self._normalise_info(track_info, album_info))
-
-                # Make multi disc directories
-                if album_info['numberOfVolumes'] > 1:
-                    disc_location = path.join(
-                        album_location,
-                        'CD{num}'.format(num=track_info['volumeNumber']))
-                    disc_location = re.sub(r'\.+$', '', disc_location)
-                    _mkdir_p(disc_location)
-
-            album_location = re.sub(r'\.+$', '', album_location)
-            if len(track_file) > 255:  # trim filename to be under OS limit (and account for file extension)
-                track_file = track_file[:250 - len(track_file)]
-            track_file = re.sub(r'\.+$', '', track_file)
-            _mkdir_p(album_location)
-
-            # Attempt to get stream URL
-            # stream_data = self.get_stream_url(track_id, quality)
-
-            DRM = False
-            playback_info = self.api.get_stream_url(track_id, self.opts['quality'])
-
-            manifest_unparsed = base64.b64decode(playback_info['manifest']).decode('UTF-8')
-            if 'ContentProtection' in manifest_unparsed:
-                DRM = True
-                print("\tWarning: DRM has been detected. If you do not have the decryption key, do not use web login.")
-            elif 'manifestMimeType' in playback_info:
-                if playback_info['manifestMimeType'] == 'application/dash+xml':
-                    raise AssertionError(f'\tUnable to download track {playback_info["trackId"]} in '
-                                         f'{playback_info["audioQuality"]}!\n')
-
-            if not DRM:
-                manifest = json.loads(manifest_unparsed)
-                # Detect codec
-                print('\tCodec: ', end='')
-                print(technical_names[manifest['codecs']])
-
-                url = manifest['urls'][0]
-                if url.find('.flac?') == -1:
-                    if url.find('.m4a?') == -1:
-                        if url.find('.mp4?') == -1:
-                            ftype = ''
-                        else:
-                            ftype = 'm4a'
-                    else:
-                        ftype = 'm4a'
-                else:
-                    ftype = 'flac'
-            # ftype needs to be changed to work with audio codecs instead when with web auth
-            else:
-                ftype = 'flac'
-
-            if album_info['numberOfVolumes'] > 1 and not track_num:
-                track_path = path.join(disc_location, track_file + '.' + ftype)
-            else:
-                track_path = path.join(album_location, track_file + '.' + ftype)
-
-            if path.isfile(track_path) and not overwrite:
-                print('\tFile {} already exists, skipping.'.format(track_path))
-                return None
-
-            self.print_track_info(track_info, album_info)
-
-            if DRM:
-                manifest = manifest_unparsed
-                # Get playback link
-                pattern = re.compile(r'(?<=media=")[^"]+')
-                playback_link = pattern.findall(manifest)[0].replace("amp;", "")
-
-                # Create album tmp folder
-                tmp_folder = os.path.join(album_location, 'tmp/')
-
-                if not os.path.isdir(tmp_folder):
-                    os.makedirs(tmp_folder)
-
-                pattern = re.compile(r'(?<= r=")[^"]+')
-                # Add 2?
-                length = int(pattern.findall(manifest)[0]) + 3
-
-                # Download all chunk files from MPD
-                with open(album_location + '/encrypted.mp4', 'wb') as encrypted_file:
-                    for i in range(length):
-                        link = playback_link.replace("$Number$", str(i))
-                        filename = os.path.join(tmp_folder, str(i).zfill(3) + '.mp4')
-                        download_file([link], 0, filename)
-                        with open(filename, 'rb') as fd:
-                            shutil.copyfileobj(fd, encrypted_file)
-                        print('\tDownload progress: {0:.0f}%'.format(((i + 1) / length) * 100), end='\r')
-                print()
-                os.chdir(album_location)
-
-                decryption_key = input("\tInput key (ID:key): ")
-                print("\tDecrypting m4a")
-                try:
-                    os.system('mp4decrypt --key {} encrypted.mp4 "{}"'.format(decryption_key, track_file + '.m4a'))
-                except Exception as e:
-                    print(e)
-                    print('mp4decrypt not found!')
+            download_stream(job.album_location, job.track_file, job.url, self.opts['resolution'], job.track_info,
+                            credits_dict, workers=self._segment_workers(), session=self.cdn_session(job.api),
+                            pipe='pipe_video_segments' in self.opts and self.opts['pipe_video_segments'])
+            return None
+
+        if job.drm or job.dash:
+            # Download all segments from the MPD concurrently, straight into a single fragmented MP4
+            job.segments_location = os.path.splitext(job.track_path)[0] + (
+                '.encrypted.mp4' if job.drm else '.dash.mp4')
+            with open(job.segments_location, 'wb') as segments_file:
+                fetch_segments(self.cdn_session(job.api), job.manifest['urls'], segments_file, self._segment_workers(),
+                               progress=lambda done, total: print(
+                                   '\tDownload progress: {0:.0f}%'.format((done / total) * 100), end='\r'))
+            print()
 
-                temp_file = track_path
-                print("\tRemuxing m4a to FLAC")
+            if job.dash:
+                print("\tRemuxing DASH segments to {}".format(job.ftype.upper()))
                 (
                     ffmpeg
-                        .input(track_file + '.m4a')
-                        .output(track_file + '.flac', acodec="copy", loglevel='warning')
+                        .input(job.segments_location)
+                        .output(job.track_path + '.part', format='flac' if job.ftype == 'flac' else 'mp4',
+                                acodec='copy', loglevel='warning')
                         .overwrite_output()
                         .run()
                 )
-                shutil.rmtree("tmp")
-                os.remove('encrypted.mp4')
-                os.remove(track_file + '.m4a')
-                os.chdir('../../')
-
+                os.replace(job.track_path + '.part', job.track_path)
+                os.remove(job.segments_location)
+                job.temp_file = job.track_path
+        else:
+            key, nonce = None, None
+            if 'encryptionType' in job.manifest and job.manifest['encryptionType'] != 'NONE':
+                if not job.manifest['keyId'] == '':
+                    print('\tLooks like file is encrypted. Decrypting while downloading...')
+                    key, nonce = decrypt_security_token(job.manifest['keyId'])
+
+            job.temp_file = self._dl_url(job.url, job.track_path, key, nonce, job.manifest.get('keyId'),
+                                         self.cdn_session(job.api))
+
+        job.artwork = self._fetch_artwork(job)
+        return job
+
+    def _fetch_artwork(self, job):
+        '''
+        Returns the album cover as bytes, downloaded at most once per release
+
+        The bytes are kept in self.artwork, Cover.jpg is only written if keep_cover_jpg is set.
+        '''
+        track_info = job.track_info
+        # The FLAC size limit may select a different cover
+        key = '{}:{}'.format(job.album_info['id'], job.ftype == 'flac')
+        aa_location = path.join(job.album_location, 'Cover.jpg')
+
+        # Tracks of the same release wait for the first one instead of downloading the cover again
+        with self.artwork.album_lock(key):
+            if key in self.artwork:
+                return self.artwork.get(key)
+
+            data = None
+            if path.isfile(aa_location):
+                with open(aa_location, 'rb') as f:
+                    data = f.read()
+
+            if data is None:
+                try:
+                    data = self._itunes_artwork(job)
+                except Exception:
+                    data = None
+
+            if data is None:
+                print('\tDownloading album art from Tidal...')
+                data = self._dl_picture(track_info['album']['cover'])
+
+            if data is not None and self.opts['keep_cover_jpg'] and not path.isfile(aa_location):
+                with open(aa_location + '.part', 'wb') as f:
+                    f.write(data)
+                os.replace(aa_location + '.part', aa_location)
+
+            self.artwork.set(key, data)
+            return data
+
+    def _itunes_artwork(self, job):
+        track_info = job.track_info
+        artwork_size = 1200
+        if 'artwork_size' in self.opts:
+            if self.opts['artwork_size'] == 0:
+                return None
+            artwork_size = self.opts['artwork_size']
+
+        # Only the matched URL is kept, the FLAC and non FLAC covers of a release share one search
+        found, album_cover = self.artwork.get_lookup(job.album_info['id'])
+        if not found:
+            print('\tDownloading album art from iTunes...')
+            params = {
+                'country': 'US',
+                'entity': 'album',
+                'term': track_info['artist']['name'] + ' ' + track_info['album']['title']
+            }
+
+            r = self.session.get('https://itunes.apple.com/search', params=params).json()
+            for i in range(len(r['results'])):
+                if job.album_info['title'] == r['results'][i]['collectionName']:
+                    # Get high resolution album cover
+                    album_cover = r['results'][i]['artworkUrl100']
+                    break
+            self.artwork.set_lookup(job.album_info['id'], album_cover)
+
+        if album_cover is None:
+            return None
+
+        compressed = 'bb'
+        if 'uncompressed_artwork' in self.opts:
+            if self.opts['uncompressed_artwork']:
+                compressed = '-999'
+        album_cover = album_cover.replace('100x100bb.jpg',
+                                          '{}x{}{}.jpg'.format(artwork_size, artwork_size, compressed))
+        data = self._dl_bytes(album_cover)
+
+        if job.ftype == 'flac':
+            # Check if cover is smaller than 16MB
+            max_size = 16777215
+            if len(data) > max_size:
+                print('\tCover file size is too large, only {0:.2f}MB are allowed.'.format(
+                    max_size / 1024 ** 2))
+                print('\tFallback to compressed iTunes cover')
+
+                album_cover = album_cover.replace('-999', 'bb')
+                data = self._dl_bytes(album_cover)
+
+        return data
+
+    def _stage_decrypt(self, job):
+        if job.drm:
+            # Work with full paths instead of changing the working directory, other tracks may be downloading
+            decrypted_location = os.path.splitext(job.track_path)[0] + '.m4a'
+            decryption_key = input("\tInput key (ID:key): ")
+            print("\tDecrypting m4a")
             try:
-                if not DRM:
-                    temp_file = self._dl_url(url, track_path)
-
-                    if 'encryptionType' in manifest and manifest['encryptionType'] != 'NONE':
-                        if not manifest['keyId'] == '':
-                            print('\tLooks like file is encrypted. Decrypting...')
-                            key, nonce = decrypt_security_token(manifest['keyId'])
-                            decrypt_file(temp_file, key, nonce)
+                os.system('mp4decrypt --key {} "{}" "{}"'.format(decryption_key, job.segments_location,
+                                                               decrypted_location))
+            except Exception as e:
+                print(e)
+                print('mp4decrypt not found!')
+
+            job.temp_file = job.track_path
+            print("\tRemuxing m4a to FLAC")
+            (
+                ffmpeg
+                    .input(decrypted_location)
+                    .output(job.track_path, acodec="copy", loglevel='warning')
+                    .overwrite_output()
+                    .run()
+            )
+            os.remove(job.segments_location)
+            os.remove(decrypted_location)
+
+        # Encrypted non-DRM streams are already decrypted while downloading
+        return job
+
+    def _stage_convert(self, job):
+        # Converting FLAC to ALAC
+        if self.opts['convert_to_alac'] and job.ftype == 'flac':
+            print("\tConverting FLAC to ALAC...")
+            conv_file = job.temp_file[:-5] + ".m4a"
+            # command = 'ffmpeg -i "{0}" -vn -c:a alac "{1}"'.format(temp_file, conv_file)
+            (
+                ffmpeg
+                    .input(job.temp_file)
+                    .output(conv_file, acodec='alac', loglevel='warning')
+                    .overwrite_output()
+                    .run()
+            )
+
+            if path.isfile(conv_file) and not job.overwrite:
+                print("\tConversion successful")
+                os.remove(job.temp_file)
+                job.temp_file = conv_file
+                job.ftype = "m4a"
+
+        return job
+
+    def _stage_tag(self, job):
+        track_info = job.track_info
+        album_info = job.album_info
+        track_path = job.track_path
+
+        # Get credits from album id
+        print('\tSaving credits to file')
+        credits_dict = {}
+        try:
+            track_credits = job.album.track_credits(track_info['id']) or []
+            for i in range(len(track_credits)):
+                credits_dict[track_credits[i]['type']] = ''
+                contributors = track_credits[i]['contributors']
+                for j in range(len(contributors)):
+                    if j != len(contributors) - 1:
+                        credits_dict[track_credits[i]['type']] += contributors[j]['name'] + ', '
+                    else:
+                        credits_dict[track_credits[i]['type']] += contributors[j]['name']
+
+            if credits_dict != {}:
+                if 'save_credits_txt' in self.opts:
+                    if self.opts['save_credits_txt']:
+                        data = ''
+                        for key, value in credits_dict.items():
+                            data += key + ': '
+                            data += value + '\n'
+                        with open((os.path.splitext(track_path)[0] + '.txt'), 'w') as f:
+                            f.write(data)
+                # Janky way to set the dict to None to tell the tagger not to include it
+                if 'embed_credits' in self.opts:
+                    if not self.opts['embed_credits']:
+                        credits_dict = None
+        except IndexError:
+            credits_dict = None
+
+        lyrics = None
+        if 'save_lyrics_lrc' in self.opts and 'embed_lyrics' in self.opts:
+            if self.opts['save_lyrics_lrc'] or self.opts['embed_lyrics']:
+                # New API lyrics call with hacky 404 fix, pls never do it that way
+                lyrics_data = job.album.track_lyrics(track_info['id'])
+
+                # Get unsynced lyrics
+                if self.opts['embed_lyrics']:
+                    if 'lyrics' in lyrics_data and lyrics_data['lyrics']:
+                        lyrics = lyrics_data['lyrics']
+                    else:
+                        print('\tNo unsynced lyrics could be found!')
+
+                # Get synced lyrics
+                if self.opts['save_lyrics_lrc']:
+                    if 'subtitles' in lyrics_data and lyrics_data['subtitles']:
+                        if not os.path.isfile(os.path.splitext(track_path)[0] + '.lrc'):
+                            with open((os.path.splitext(track_path)[0] + '.lrc'), 'wb') as f:
+                                f.write(lyrics_data['subtitles'].encode('utf-8'))
+                    else:
+                        print('\tNo synced lyrics could be found!')
 
-                aa_location = path.join(album_location, 'Cover.jpg')
-                if not path.isfile(aa_location):
-                    try:
-                        artwork_size = 1200
-                        if 'artwork_size' in self.opts:
-                            if self.opts['artwork_size'] == 0:
-                                raise Exception
-                            artwork_size = self.opts['artwork_size']
-
-                        print('\tDownloading album art from iTunes...')
-                        s = requests.Session()
-
-                        params = {
-                            'country': 'US',
-                            'entity': 'album',
-                            'term': track_info['artist']['name'] + ' ' + track_info['album']['title']
-                        }
-
-                        r = s.get('https://itunes.apple.com/search', params=params)
-                        r = r.json()
-                        album_cover = None
-
-                        for i in range(len(r['results'])):
-                            if album_info['title'] == r['results'][i]['collectionName']:
-                                # Get high resolution album cover
-                                album_cover = r['results'][i]['artworkUrl100']
-                                break
-
-                        if album_cover is None:
-                            raise Exception
-
-                        compressed = 'bb'
-                        if 'uncompressed_artwork' in self.opts:
-                            if self.opts['uncompressed_artwork']:
-                                compressed = '-999'
-                        album_cover = album_cover.replace('100x100bb.jpg',
-                                                          '{}x{}{}.jpg'.format(artwork_size, artwork_size, compressed))
-                        self._dl_url(album_cover, aa_location)
-
-                        if ftype == 'flac':
-                            # Open cover.jpg to check size
-                            with open(aa_location, 'rb') as f:
-                                data = f.read()
-
-                            # Check if cover is smaller than 16MB
-                            max_size = 16777215
-                            if len(data) > max_size:
-                                print('\tCover file size is too large, only {0:.2f}MB are allowed.'.format(
-                                    max_size / 1024 ** 2))
-                                print('\tFallback to compressed iTunes cover')
-
-                                album_cover = album_cover.replace('-999', 'bb')
-                                self._dl_url(album_cover, aa_location)
-                    except:
-                        print('\tDownloading album art from Tidal...')
-                        if not self._dl_picture(track_info['album']['cover'], aa_location):
-                            aa_location = None
-
-                # Converting FLAC to ALAC
-                if self.opts['convert_to_alac'] and ftype == 'flac':
-                    print("\tConverting FLAC to ALAC...")
-                    conv_file = temp_file[:-5] + ".m4a"
-                    # command = 'ffmpeg -i "{0}" -vn -c:a alac "{1}"'.format(temp_file, conv_file)
-                    (
-                        ffmpeg
-                            .input(temp_file)
-                            .output(conv_file, acodec='alac', loglevel='warning')
-                            .overwrite_output()
-                            .run()
-                    )
-
-                    if path.isfile(conv_file) and not overwrite:
-                        print("\tConversion successful")
-                        os.remove(temp_file)
-                        temp_file = conv_file
-                        ftype = "m4a"
-
-                # Get credits from album id
-                print('\tSaving credits to file')
-                album_credits = self.credits_from_album(str(album_info['id']))
-                credits_dict = {}
-                try:
-                    track_credits = album_credits['items'][track_info['trackNumber'] - 1]['credits']
-                    for i in range(len(track_credits)):
-                        credits_dict[track_credits[i]['type']] = ''
-                        contributors = track_credits[i]['contributors']
-                        for j in range(len(contributors)):
-                            if j != len(contributors) - 1:
-                                credits_dict[track_credits[i]['type']] += contributors[j]['name'] + ', '
-                            else:
-                                credits_dict[track_credits[i]['type']] += contributors[j]['name']
-
-                    if credits_dict != {}:
-                        if 'save_credits_txt' in self.opts:
-                            if self.opts['save_credits_txt']:
-                                data = ''
-                                for key, value in credits_dict.items():
-                                    data += key + ': '
-                                    data += value + '\n'
-                                with open((os.path.splitext(track_path)[0] + '.txt'), 'w') as f:
-                                    f.write(data)
-                        # Janky way to set the dict to None to tell the tagger not to include it
-                        if 'embed_credits' in self.opts:
-                            if not self.opts['embed_credits']:
-                                credits_dict = None
-                except IndexError:
-                    credits_dict = None
-
-                lyrics = None
-                if 'save_lyrics_lrc' in self.opts and 'embed_lyrics' in self.opts:
-                    if self.opts['save_lyrics_lrc'] or self.opts['embed_lyrics']:
-                        # New API lyrics call with hacky 404 fix, pls never do it that way
-                        lyrics_data = self.lyrics_from_track(track_id)
-
-                        # Get unsynced lyrics
-                        if self.opts['embed_lyrics']:
-                            if 'lyrics' in lyrics_data and lyrics_data['lyrics']:
-                                lyrics = lyrics_data['lyrics']
-                            else:
-                                print('\tNo unsynced lyrics could be found!')
-
-                        # Get synced lyrics
-                        if self.opts['save_lyrics_lrc']:
-                            if 'subtitles' in lyrics_data and lyrics_data['subtitles']:
-                                if not os.path.isfile(os.path.splitext(track_path)[0] + '.lrc'):
-                                    with open((os.path.splitext(track_path)[0] + '.lrc'), 'wb') as f:
-                                        f.write(lyrics_data['subtitles'].encode('utf-8'))
-                            else:
-                                print('\tNo synced lyrics could be found!')
-
-                # Tagging
-                print('\tTagging media file...')
-
-                if ftype == 'flac':
-                    self.tm.tag_flac(temp_file, track_info, album_info, lyrics, credits_dict=credits_dict,
-                                     album_art_path=aa_location)
-                elif ftype == 'm4a' or ftype == 'mp4':
-                    self.tm.tag_m4a(temp_file, track_info, album_info, lyrics, credits_dict=credits_dict,
-                                    album_art_path=aa_location)
-                else:
-                    print('\tUnknown file type to tag!')
+        # Tagging
+        print('\tTagging media file...')
 
-                # Cleanup
-                if not self.opts['keep_cover_jpg'] and aa_location:
-                    os.remove(aa_location)
+        if job.ftype == 'flac':
+            self.tm.tag_flac(job.temp_file, track_info, album_info, lyrics, credits_dict=credits_dict,
+                             album_art=job.artwork)
+        elif job.ftype == 'm4a' or job.ftype == 'mp4':
+            self.tm.tag_m4a(job.temp_file, track_info, album_info, lyrics, credits_dict=credits_dict,
+                            album_art=job.artwork)
+        else:
+            print('\tUnknown file type to tag!')
 
-                return album_location, temp_file
+        self._index_job(job, job.temp_file)
 
-            # Delete partially downloaded file on keyboard interrupt
-            except KeyboardInterrupt:
-                if path.isfile(track_path):
-                    print('Deleting partially downloaded file ' + str(track_path))
-                    os.remove(track_path)
-                raise
+        return job
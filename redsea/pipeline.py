@@ -0,0 +1,84 @@
+import queue
+import threading
+
+
+class Stage(object):
+    '''
+    A named step of a Pipeline which is run by its own pool of worker threads
+    '''
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+
+
+class Pipeline(object):
+    '''
+    Passes jobs through a chain of stages which are joined by bounded queues
+
+    Each stage function receives a job and returns it to hand it over to the next stage,
+    or returns None if the job is already finished (e.g. the file exists). If a stage raises,
+    the exception is stored in job.error and the remaining stages are skipped.
+    Finished jobs are collected with get().
+    '''
+
+    _STOP = object()
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+        # Unbounded, so a worker never blocks on handing over a finished job
+        self.done = queue.Queue()
+        self.threads = [[] for _ in stages]
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(index,),
+                                          name='{}-{}'.format(stage.name, i), daemon=True)
+                thread.start()
+                self.threads[index].append(thread)
+        return self
+
+    def _work(self, index):
+        stage = self.stages[index]
+        while True:
+            job = self.queues[index].get()
+            if job is self._STOP:
+                return
+
+            try:
+                result = stage.func(job)
+            except Exception as e:
+                job.error = e
+                result = None
+
+            if result is None or index == len(self.stages) - 1:
+                self.done.put(job)
+            else:
+                self.queues[index + 1].put(job)
+
+    def submit(self, job):
+        '''
+        Adds a job to the first stage, blocks while the first queue is full
+        '''
+        job.error = None
+        self.queues[0].put(job)
+
+    def get(self):
+        '''
+        Returns the next finished job, blocks until one is available
+        '''
+        return self.done.get()
+
+    def close(self):
+        '''
+        Stops all workers once every submitted job passed through the stages
+        '''
+        for index, stage in enumerate(self.stages):
+            # Previous stages are stopped already, so nothing can be queued after the stop markers
+            for _ in range(stage.workers):
+                self.queues[index].put(self._STOP)
+            for thread in self.threads[index]:
+                thread.join()
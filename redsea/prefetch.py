@@ -0,0 +1,75 @@
+import base64
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Stream urls without a known expiry are refetched after this many seconds
+MAX_AGE = 300
+# Stream urls are not used anymore if they expire within this many seconds
+EXPIRY_MARGIN = 60
+
+# Signed CDN urls carry their expiry as a unix timestamp, e.g. token=1700000000~... or Expires=1700000000
+_EXPIRY_PATTERN = re.compile(r'(?:[?&](?:expires|exp)=|token=|exp=)(\d{10})(?!\d)', re.IGNORECASE)
+
+
+def playback_expiry(playback_info, fetched):
+    '''
+    Returns the time until the stream urls of a playback info response may be used
+    '''
+    text = playback_info.get('url', '')
+    if 'manifest' in playback_info:
+        try:
+            text += base64.b64decode(playback_info['manifest']).decode('UTF-8')
+        except (ValueError, UnicodeDecodeError):
+            pass
+
+    expiries = [int(t) for t in _EXPIRY_PATTERN.findall(text)]
+    if expiries:
+        return min(expiries) - EXPIRY_MARGIN
+    return fetched + MAX_AGE
+
+
+class Prefetcher(object):
+    '''
+    Runs func for upcoming jobs in the background and stores the future in job.prefetch
+
+    At most lookahead jobs are prefetched at the same time.
+    '''
+
+    def __init__(self, func, lookahead=2):
+        self.func = func
+        self.lookahead = max(1, lookahead)
+        self.executor = ThreadPoolExecutor(max_workers=self.lookahead, thread_name_prefix='prefetch')
+
+    def schedule(self, jobs):
+        for job in jobs[:self.lookahead]:
+            if job.prefetch is None:
+                job.prefetch = self.executor.submit(self.func, job)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def take_prefetched(job):
+    '''
+    Returns the prefetched playback info of a job if it is still usable, otherwise None
+    '''
+    future, job.prefetch = job.prefetch, None
+    if future is None or future.cancelled():
+        return None
+
+    try:
+        prefetched = future.result()
+    except Exception:
+        # Fetched again by the stage, which reports the error
+        return None
+
+    # The session may have been switched since
+    if prefetched is None or prefetched['api'] is not job.api:
+        return None
+
+    if prefetched['expires'] <= time.time():
+        print('\tPrefetched stream URL expired, fetching it again...')
+        return None
+
+    return prefetched['playback_info']
@@ -0,0 +1,183 @@
+import re
+import threading
+import time
+import weakref
+from email.utils import parsedate_to_datetime
+
+from requests.adapters import HTTPAdapter
+
+# Requests per second and concurrent requests per account and endpoint class, see "rate_limits" in settings.py
+RATE_LIMITS = {
+    'metadata': (10, 8),
+    'playback': (4, 4),
+    'cdn': (50, 16)
+}
+
+# Seconds to back off after a 429 without a Retry-After header
+DEFAULT_BACKOFF = 2
+
+_PLAYBACK_PATTERN = re.compile(r'/(playbackinfo\w*|streamurl|urlpostpaywall)(\?|$)')
+_API_PATTERN = re.compile(r'^https?://api\.tidal(hifi)?\.com/')
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def configure(limits):
+    '''
+    Overrides the default rate and concurrency of endpoint classes, applies to limiters created afterwards
+    '''
+    RATE_LIMITS.update(limits)
+
+
+def endpoint_class(url):
+    if _API_PATTERN.match(url):
+        return 'playback' if _PLAYBACK_PATTERN.search(url) else 'metadata'
+    return 'cdn'
+
+
+def get_limiters(account=None):
+    '''
+    Returns the limiters of an account as {endpoint class: AdaptiveLimiter}, created on first use
+    '''
+    with _lock:
+        if account not in _limiters:
+            _limiters[account] = {kind: AdaptiveLimiter(rate, concurrency)
+                                  for kind, (rate, concurrency) in RATE_LIMITS.items()}
+        return _limiters[account]
+
+
+def retry_after(response):
+    '''
+    Returns the seconds to wait according to the Retry-After header of a response, or None
+    '''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter(object):
+    '''
+    Token bucket which spaces requests to at most rate per second, combined with an AIMD concurrency limit
+
+    Every successful request raises the concurrency limit by 1/limit (about one per round of requests) and the
+    rate by 1/rate, up to the configured maximums. A 429 halves both, once per backoff, and blocks new requests
+    until the Retry-After delay has passed, so throughput settles just below the limit of the server.
+    '''
+
+    def __init__(self, rate, concurrency):
+        self.max_rate = float(rate)
+        self.max_concurrency = float(concurrency)
+        self.rate = self.max_rate
+        self.concurrency = self.max_concurrency
+        self.tokens = 1.0
+        self.last = time.time()
+        self.active = 0
+        self.blocked_until = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                if now < self.blocked_until:
+                    self.cond.wait(self.blocked_until - now)
+                    continue
+
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.active < int(self.concurrency) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+
+                # Woken up by a release if only the concurrency limit is reached
+                self.cond.wait((1 - self.tokens) / self.rate if self.tokens < 1 else None)
+
+    def release(self, throttled=False, delay=None):
+        with self.cond:
+            self.active -= 1
+            if throttled:
+                # Requests which were sent before the first 429 do not lower the limits again
+                if time.time() < self.blocked_until:
+                    self.cond.notify_all()
+                    return
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self.rate = max(0.5, self.rate / 2)
+                self.tokens = 0.0
+                self.blocked_until = max(self.blocked_until,
+                                         time.time() + (delay if delay is not None else DEFAULT_BACKOFF))
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+            self.cond.notify_all()
+
+
+class LimitedAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter which passes every request through the limiter of its endpoint class and retries it after a 429
+
+    A request keeps its concurrency slot until its response is read completely or closed, so streamed
+    downloads count against the limit for as long as they transfer.
+    '''
+
+    def __init__(self, limiters, tries=8, **kwargs):
+        self.limiters = limiters
+        self.tries = tries
+        super(LimitedAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        limiter = self.limiters[endpoint_class(request.url)]
+        for attempt in range(self.tries):
+            limiter.acquire()
+            try:
+                response = super(LimitedAdapter, self).send(request, **kwargs)
+            except BaseException:
+                limiter.release()
+                raise
+
+            if response.status_code != 429 or attempt == self.tries - 1:
+                self._hold(limiter, response)
+                return response
+
+            limiter.release(throttled=True, delay=retry_after(response))
+            response.close()
+        return response
+
+    @staticmethod
+    def _hold(limiter, response):
+        # Releases the slot once urllib3 returns the connection to the pool or the response is closed
+        lock = threading.Lock()
+        held = [True]
+
+        def release():
+            with lock:
+                if not held[0]:
+                    return
+                held[0] = False
+            limiter.release()
+
+        def releasing(func):
+            def wrapper(*args, **kwargs):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    release()
+            return wrapper
+
+        raw = response.raw
+        if raw is None or not hasattr(raw, 'release_conn'):
+            release()
+            return
+        raw.release_conn = releasing(raw.release_conn)
+        raw.close = releasing(raw.close)
+        # A response which is neither read nor closed gives up its slot once it is garbage collected
+        weakref.finalize(response, release)
@@ -0,0 +1,86 @@
+import threading
+from datetime import datetime
+
+# Tokens are renewed this many seconds before they expire
+REFRESH_MARGIN = 300
+
+
+class TokenRefresher(object):
+    '''
+    Renews the access tokens of Mobile/TV sessions on a background thread, margin seconds before they expire
+
+    Refreshes are single-flight: requests which find a token expired or get a 401 at the same time wait for
+    one refresh and then use the new token. Every refreshed session is saved to the session file.
+    '''
+
+    def __init__(self, session_file, margin=REFRESH_MARGIN):
+        self.session_file = session_file
+        self.margin = margin
+        self.sessions = {}  # id(session) -> session, all sessions which were used so far
+        self.locks = {}  # id(session) -> lock held while the session is refreshed
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='token-refresher', daemon=True).start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self._next_wait()):
+            for session in list(self.sessions.values()):
+                if session.expired(self.margin):
+                    try:
+                        self.refresh(session, session.access_token)
+                    except Exception as e:
+                        # e.g. a connection error, tried again after the next wait
+                        print('\tERROR: Refreshing the token of {} failed: {}'.format(session.username, e))
+
+    def _next_wait(self):
+        # Sessions may be added at any time, so check at least every minute. Failed refreshes are retried
+        # after half a minute at the earliest
+        wait = 60
+        for session in list(self.sessions.values()):
+            expiry = session.expiry()
+            if expiry is not None:
+                wait = min(wait, (expiry - datetime.now()).total_seconds() - self.margin)
+        return max(30, wait)
+
+    def watch(self, session):
+        '''
+        Keeps the token of a session fresh, returns False for sessions which can not be refreshed
+        '''
+        if not hasattr(session, 'refresh_token'):
+            return False
+        with self.lock:
+            if id(session) not in self.sessions:
+                self.sessions[id(session)] = session
+                self.locks[id(session)] = threading.Lock()
+        return True
+
+    def ensure(self, session):
+        '''
+        Refreshes the token of a session before a request if it already expired, e.g. after the computer slept
+        '''
+        if self.watch(session) and session.expired():
+            self.refresh(session, session.access_token)
+
+    def refresh(self, session, stale_token):
+        '''
+        Refreshes a session whose stale_token was rejected, unless another thread already did
+
+        Returns True if the session has a different token now
+        '''
+        if not self.watch(session):
+            return False
+
+        with self.locks[id(session)]:
+            if session.access_token != stale_token:
+                return True
+
+            if not session.refresh():
+                return False
+            self.session_file._save()
+        return True
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,192 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueResolver(object):
+    '''
+    Reads the queue items and resolves the tracks and albums among them on background threads, ahead of the downloads
+
+    The queue is iterated as (item, media) pairs, media may be any iterable (e.g. a file which is read lazily).
+    Consecutive track items are looked up together with a single multi-id request, a batch is sent early
+    if the caller is waiting for one of its items. At most window items
+    ahead of the item which is downloaded are read and resolved, so memory use does not depend on the length
+    of the queue. Requests are spaced to stay below rate per second. Items for which skip(item, media) returns
+    True or which could not be resolved in the background (e.g. region-locked) are left to the caller.
+    '''
+
+    def __init__(self, api, media, workers=4, rate=10, window=200, batch_size=50, skip=None):
+        self.api = api
+        self.media = media
+        self.window = window
+        self.batch_size = batch_size
+        self.skip = skip
+
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='resolve')
+        self.items = {}  # Read but not yet iterated items
+        self.futures = {}
+        self.consumed = 0
+        self.position = 0
+        self.read = 0
+        self.batch = []  # (item, track id) of tracks which are not submitted yet
+        self.resolved = 0
+        # Number of items, known once the input is read completely
+        self.count = None
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_request = 0
+        self.rate_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name='resolver', daemon=True).start()
+        return self
+
+    def _throttle(self):
+        with self.rate_lock:
+            now = time.time()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def _run(self):
+        try:
+            self._read()
+        except BaseException as e:
+            # e.g. an invalid URL in the input file, raised by the iteration
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+
+    def _read(self):
+        for item, media in enumerate(self.media):
+            # Reading the next item may block (e.g. stdin), everything else happens under the lock
+            with self.cond:
+                if item >= self.consumed + self.window:
+                    # Submit the collected tracks before waiting, the caller may be waiting for them
+                    self._flush()
+                    while item >= self.consumed + self.window and not self.closed:
+                        self.cond.wait()
+                if self.closed:
+                    return
+
+                self.items[item] = media
+                self.read = item + 1
+                # Items are decided on before the caller can iterate them
+                if item >= self.consumed and not (self.skip and self.skip(item, media)):
+                    if media['type'] == 't':
+                        self.batch.append((item, media['id']))
+                        if len(self.batch) >= self.batch_size:
+                            self._flush()
+                    elif media['type'] == 'a':
+                        self._submit(item, self.executor.submit(self._resolve_album, media['id']))
+
+                if not self.batch:
+                    self._advance(self.read)
+                self.cond.notify_all()
+
+        with self.cond:
+            self._flush()
+            self.count = self.read
+
+    def _flush(self):
+        # Submits the collected tracks, called with the lock held
+        batch, self.batch = self.batch, []
+        self._submit_tracks(batch)
+        self._advance(self.read)
+
+    def _advance(self, position):
+        # All items before position are submitted or left to the caller
+        with self.cond:
+            self.position = position
+            self.cond.notify_all()
+
+    def _submit(self, item, future):
+        # Tracks are submitted as (future of the batch, track id)
+        (future[0] if isinstance(future, tuple) else future).add_done_callback(self._count)
+        with self.cond:
+            self.futures[item] = future
+            self.cond.notify_all()
+
+    def _count(self, future):
+        with self.cond:
+            self.resolved += 1
+
+    def _submit_tracks(self, batch):
+        if not batch:
+            return
+        future = self.executor.submit(self._resolve_tracks, [track_id for _, track_id in batch])
+        for item, track_id in batch:
+            self._submit(item, (future, str(track_id)))
+
+    def _resolve_tracks(self, ids):
+        self._throttle()
+        return {str(track['id']): track for track in self.api.get_tracks(ids)}
+
+    def _resolve_album(self, album_id):
+        self._throttle()
+        album_info = self.api.get_album(album_id)
+        self._throttle()
+        return album_info, self.api.get_album_tracks(album_id)['items']
+
+    def __iter__(self):
+        item = 0
+        while True:
+            with self.cond:
+                while item not in self.items and self.error is None and not self.closed and \
+                        (self.count is None or item < self.count):
+                    self.cond.wait()
+                if self.error is not None:
+                    raise self.error
+                if item not in self.items:
+                    return
+
+                media = self.items.pop(item)
+                # Moves the window ahead, even if the caller skips the item
+                self.consumed = max(self.consumed, item + 1)
+                self.cond.notify_all()
+            yield item, media
+            item += 1
+
+    def get(self, item):
+        '''
+        Returns the resolved track or (album_info, tracks) of an item, or None if the caller has to resolve it
+
+        Marks all items before this one as consumed, so the resolver moves its window ahead.
+        '''
+        with self.cond:
+            self.consumed = max(self.consumed, item + 1)
+            self.cond.notify_all()
+            while self.position <= item and self.error is None and not self.closed:
+                if item < self.read:
+                    # The item waits in the batch for more tracks, which may take long (e.g. slow stdin)
+                    self._flush()
+                    continue
+                self.cond.wait()
+            future = self.futures.pop(item, None)
+
+        if future is None:
+            return None
+
+        track_id = None
+        if isinstance(future, tuple):
+            future, track_id = future
+
+        try:
+            result = future.result()
+        except Exception:
+            return None
+
+        if track_id is not None:
+            return result.get(track_id)
+        return result
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.futures.clear()
+            self.cond.notify_all()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def fetch_segment(session, url):
+    r = session.get(url, verify=False)
+    r.raise_for_status()
+    return r.content
+
+
+def fetch_segments(session, urls, out, workers=8, progress=None):
+    '''
+    Fetches the segment urls concurrently and writes them to the file object out in their order
+
+    At most 2 * workers segments are requested or waiting to be written at the same time,
+    so memory use does not grow with the number of segments.
+    progress is called with (done, total) after every written segment
+    '''
+
+    total = len(urls)
+    window = max(1, workers) * 2
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {}
+        try:
+            for i in range(min(window, total)):
+                futures[i] = executor.submit(fetch_segment, session, urls[i])
+
+            for i in range(total):
+                out.write(futures.pop(i).result())
+
+                # Keep the window filled
+                if i + window < total:
+                    futures[i + window] = executor.submit(fetch_segment, session, urls[i + window])
+
+                if progress:
+                    progress(i + 1, total)
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            raise
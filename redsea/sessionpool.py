@@ -0,0 +1,55 @@
+import threading
+
+from .tidal_api import TidalApi
+
+
+class SessionPool(object):
+    '''
+    Spreads download jobs over all sessions which can download the same tracks as the selected one
+
+    Sessions are eligible if they are in the same region (country code) and of the same type (Mobile, TV or
+    Desktop), as the type decides which codecs are available. Every account has its own rate budget and
+    connection pool, so throughput grows with the number of accounts. A job gets the session with the fewest
+    jobs in flight, ties go to the session which was used least.
+    '''
+
+    def __init__(self, api, sessions):
+        self.apis = [api]
+        for session, name in sessions:
+            if session is api.session or session.country_code != api.session.country_code or \
+                    session.session_type() != api.session.session_type():
+                continue
+            # Sessions which can not be refreshed anymore are left out
+            if session.expired() and not hasattr(session, 'refresh_token'):
+                continue
+            self.apis.append(TidalApi(session))
+
+        self.load = {id(a): 0 for a in self.apis}
+        self.uses = {id(a): 0 for a in self.apis}
+        self.jobs = {}  # id(job) -> TidalApi the job was assigned to
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.apis)
+
+    def assign(self, job):
+        '''
+        Sets job.api to the least loaded session, unless the job was assigned already
+        '''
+        with self.lock:
+            if id(job) in self.jobs:
+                return
+            api = min(self.apis, key=lambda a: (self.load[id(a)], self.uses[id(a)]))
+            self.load[id(api)] += 1
+            self.uses[id(api)] += 1
+            self.jobs[id(job)] = api
+        job.api = api
+
+    def release(self, job):
+        '''
+        Marks a job as finished, its session can take the next one
+        '''
+        with self.lock:
+            api = self.jobs.pop(id(job), None)
+            if api is not None:
+                self.load[id(api)] -= 1
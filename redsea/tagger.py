@@ -144,14 +144,30 @@ class Tagger(object):
     def _meta_tag(self, tagger, track_info, album_info, track_type):
         self.tags(track_info, track_type, album_info, tagger)
 
-    def tag_flac(self, file_path, track_info, album_info, lyrics, credits_dict=None, album_art_path=None):
+    @staticmethod
+    def clear_tags(file_path, track_type):
+        '''
+        Removes all tags and pictures of a file, so a copy of another release can be tagged again
+        '''
+        if track_type == 'flac':
+            tagger = FLAC(file_path)
+            tagger.clear_pictures()
+            tagger.save()
+            tagger.delete()
+        else:
+            EasyMP4(file_path).delete()
+
+    def tag_flac(self, file_path, track_info, album_info, lyrics, credits_dict=None, album_art_path=None, album_art=None):
         tagger = FLAC(file_path)
 
         self._meta_tag(tagger, track_info, album_info, 'flac')
-        if self.fmtopts['embed_album_art'] and album_art_path is not None:
-            pic = Picture()
+        if album_art is None and album_art_path is not None:
             with open(album_art_path, 'rb') as f:
-                pic.data = f.read()
+                album_art = f.read()
+
+        if self.fmtopts['embed_album_art'] and album_art is not None:
+            pic = Picture()
+            pic.data = album_art
 
             # Check if cover is smaller than 16MB
             if len(pic.data) < pic._MAX_SIZE:
@@ -174,7 +190,7 @@ class Tagger(object):
 
         tagger.save(file_path)
 
-    def tag_m4a(self, file_path, track_info, album_info, lyrics, credits_dict=None, album_art_path=None):
+    def tag_m4a(self, file_path, track_info, album_info, lyrics, credits_dict=None, album_art_path=None, album_art=None):
         tagger = EasyMP4(file_path)
 
         # Register ISRC, UPC, lyrics and explicit tags
@@ -184,10 +200,12 @@ class Tagger(object):
         tagger.RegisterTextKey('lyrics', '\xa9lyr')
 
         self._meta_tag(tagger, track_info, album_info, 'm4a')
-        if self.fmtopts['embed_album_art'] and album_art_path is not None:
-            pic = None
+        if album_art is None and album_art_path is not None:
             with open(album_art_path, 'rb') as f:
-                pic = MP4Cover(f.read())
+                album_art = f.read()
+
+        if self.fmtopts['embed_album_art'] and album_art is not None:
+            pic = MP4Cover(album_art)
             tagger.RegisterTextKey('covr', 'covr')
             tagger['covr'] = [pic]
 
@@ -13,13 +13,16 @@ from datetime import datetime, timedelta
 import urllib3
 import time
 import sys
+import threading
 import prettytable
 
 import requests
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
 from subprocess import Popen, PIPE
 
+from .cache import ResponseCache
+from .clients import get_session
+from .dash import parse_mpd
+
 from config.settings import TOKEN, MOBILE_TOKEN, TV_TOKEN, TV_SECRET, SHOWAUTH
 
 technical_names = {
@@ -34,6 +37,43 @@ technical_names = {
 }
 
 
+# Seconds a response of an endpoint is cached for, the first matching pattern wins. Stream URLs are never cached
+CACHE_TTLS = [
+    (re.compile(r'/playbackinfopostpaywall$'), 0),
+    (re.compile(r'^videos/\d+/streamurl$'), 0),
+    (re.compile(r'^users/'), 0),
+    (re.compile(r'^search'), 0),
+    (re.compile(r'/lyrics$'), 6 * 3600),
+    (re.compile(r'/credits$|/contributors$'), 6 * 3600),
+    (re.compile(r'^(albums|tracks|videos)(/|$)'), 6 * 3600),
+    (re.compile(r'^artists/'), 3600),
+    (re.compile(r'^(playlists|pages)/'), 600)
+]
+
+
+def cache_ttl(url):
+    for pattern, ttl in CACHE_TTLS:
+        if pattern.search(url):
+            return ttl
+    return 0
+
+
+# Access tokens are refreshed if they expire within this many seconds
+TOKEN_EXPIRY_MARGIN = 60
+
+
+def jwt_expiry(token):
+    '''
+    Returns the expiry ("exp" claim) of a JWT access token as a datetime, or None if it has none
+    '''
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return datetime.fromtimestamp(int(claims['exp']))
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
 class TidalRequestError(Exception):
     def __init__(self, payload):
         sf = '{subStatus}: {userMessage} (HTTP {status})'.format(**payload)
@@ -57,15 +97,15 @@ class TidalApi:
     TIDAL_VIDEO_BASE = 'https://api.tidalhifi.com/v1/'
     TIDAL_CLIENT_VERSION = '2.26.1'
 
+    # Shared by all instances, so metadata is only requested once per run
+    cache = ResponseCache()
+    # Renews the tokens of Mobile/TV sessions, set by redsea.py
+    refresher = None
+
     def __init__(self, session):
         self.session = session
-        self.s = requests.Session()
-        retries = Retry(total=10,
-                        backoff_factor=0.4,
-                        status_forcelist=[429, 500, 502, 503, 504])
-
-        self.s.mount('http://', HTTPAdapter(max_retries=retries))
-        self.s.mount('https://', HTTPAdapter(max_retries=retries))
+        # Shared by all TidalApi instances, the auth headers are passed with every request
+        self.s = get_session('tidal', pool_size=16, account=getattr(session, 'user_id', None))
 
     def _get(self, url, params=None, refresh=False):
         if params is None:
@@ -75,6 +115,18 @@ class TidalApi:
         if 'limit' not in params:
             params['limit'] = '9999'
 
+        # The country code is part of the params, so regions do not share responses
+        ttl = cache_ttl(url)
+        cache_key = json.dumps([url, params], sort_keys=True, default=str)
+        if ttl > 0:
+            resp_json = self.cache.get(cache_key)
+            if resp_json is not None:
+                return resp_json
+
+        if self.refresher is not None:
+            self.refresher.ensure(self.session)
+        access_token = getattr(self.session, 'access_token', None)
+
         # Catch video for different base
         if url[:5] == 'video':
             resp = self.s.get(
@@ -91,7 +143,11 @@ class TidalApi:
 
         # if the request 401s or 403s, try refreshing the TV/Mobile session in case that helps
         if not refresh and (resp.status_code == 401 or resp.status_code == 403):
-            if isinstance(self.session, TidalMobileSession) or isinstance(self.session, TidalTvSession):
+            if self.refresher is not None:
+                # Concurrent requests which got a 401 share a single refresh
+                if self.refresher.refresh(self.session, access_token):
+                    return self._get(url, params, True)
+            elif isinstance(self.session, TidalMobileSession) or isinstance(self.session, TidalTvSession):
                 self.session.refresh()
                 return self._get(url, params, True)
 
@@ -119,6 +175,7 @@ class TidalApi:
         if 'status' in resp_json and not resp_json['status'] == 200:
             raise TidalRequestError(resp_json)
 
+        self.cache.set(cache_key, resp_json, ttl)
         return resp_json
 
     def get_stream_url(self, track_id, quality):
@@ -147,13 +204,29 @@ class TidalApi:
         })
 
     def get_credits(self, album_id):
-        return self._get('albums/' + album_id + '/items/credits', params={
+        result = self._get('albums/' + str(album_id) + '/items/credits', params={
             'replace': True,
             'offset': 0,
             'limit': 50,
             'includeContributors': True
         })
 
+        # Albums with more than 50 tracks are split into several pages
+        offset = len(result['items'])
+        while 'totalNumberOfItems' in result and offset < result['totalNumberOfItems']:
+            buf = self._get('albums/' + str(album_id) + '/items/credits', params={
+                'replace': True,
+                'offset': offset,
+                'limit': 50,
+                'includeContributors': True
+            })
+            if not buf['items']:
+                break
+            offset += len(buf['items'])
+            result['items'] += buf['items']
+
+        return result
+
     def get_video_credits(self, video_id):
         return self._get('videos/' + video_id + '/contributors', params={
             'limit': 50
@@ -197,6 +270,12 @@ class TidalApi:
     def get_track(self, track_id):
         return self._get('tracks/' + str(track_id))
 
+    def get_tracks(self, track_ids):
+        '''
+        Returns the tracks of several ids with a single request, unavailable tracks are left out
+        '''
+        return self._get('tracks', params={'ids': ','.join(str(i) for i in track_ids)})['items']
+
     def get_album(self, album_id):
         return self._get('albums/' + str(album_id))
 
@@ -280,21 +359,24 @@ class SessionFormats:
         api = TidalApi(session)
 
         for id in [self.dolby_trackid, self.sony_trackid]:
-            playback_info = api.get_stream_url(id, ['LOW'])
-            if playback_info['manifestMimeType'] == 'application/dash+xml':
-                continue
-            manifest_unparsed = base64.b64decode(playback_info['manifest']).decode('UTF-8')
-            if 'ContentProtection' not in manifest_unparsed:
-                self.formats[json.loads(manifest_unparsed)['codecs']] = True
+            self._check_playback_info(api.get_stream_url(id, ['LOW']))
 
         for i in range(len(self.quality)):
-            playback_info = api.get_stream_url(self.mqa_trackid, [self.quality[i]])
-            if playback_info['manifestMimeType'] == 'application/dash+xml':
-                continue
+            self._check_playback_info(api.get_stream_url(self.mqa_trackid, [self.quality[i]]))
+
+    def _check_playback_info(self, playback_info):
+        manifest_unparsed = base64.b64decode(playback_info['manifest']).decode('UTF-8')
+        if 'ContentProtection' in manifest_unparsed:
+            return
+
+        # Unprotected DASH streams can be downloaded as well
+        if playback_info['manifestMimeType'] == 'application/dash+xml':
+            codecs = parse_mpd(manifest_unparsed)['codecs']
+        else:
+            codecs = json.loads(manifest_unparsed)['codecs']
 
-            manifest_unparsed = base64.b64decode(playback_info['manifest']).decode('UTF-8')
-            if 'ContentProtection' not in manifest_unparsed:
-                self.formats[json.loads(manifest_unparsed)['codecs']] = True
+        if codecs in self.formats:
+            self.formats[codecs] = True
 
     def print_fomats(self):
         table = prettytable.PrettyTable()
@@ -425,13 +507,29 @@ class TidalSession:
         '''
         Checks if session is still valid and returns True/False
         '''
-        if not isinstance(self, TidalSession):
-            if self.access_token is None or datetime.now() > self.expires:
-                return False
+        if self.expired(margin=0):
+            return False
 
         r = requests.get(f'{self.TIDAL_API_BASE}sessions', headers=self.auth_headers(), verify=False)
         return r.status_code == 200
 
+    def expiry(self):
+        '''
+        Returns when the access token expires, or None if it is not known (e.g. desktop sessions)
+        '''
+        access_token = getattr(self, 'access_token', None)
+        expiries = [e for e in (getattr(self, 'expires', None), jwt_expiry(access_token)) if e is not None]
+        return min(expiries) if expiries else None
+
+    def expired(self, margin=TOKEN_EXPIRY_MARGIN):
+        '''
+        Checks locally, without a request, if the access token is missing or expires within margin seconds
+        '''
+        if hasattr(self, 'access_token') and self.access_token is None:
+            return True
+        expiry = self.expiry()
+        return expiry is not None and datetime.now() + timedelta(seconds=margin) >= expiry
+
     def auth_headers(self):
         return {
             'Host': 'api.tidal.com',
@@ -775,10 +873,13 @@ class TidalSessionFile(object):
         self.session_store = {}  # Will contain data from session file
         self.sessions = {}  # Will contain sessions from session_store['sessions']
         self.default = None  # Specifies the name of the default session to use
+        self.saved = None  # Contents of the session file, it is only written if they changed
+        self.save_lock = threading.Lock()
 
         if os.path.isfile(self.session_file):
             with open(self.session_file, 'rb') as f:
-                self.session_store = pickle.load(f)
+                self.saved = f.read()
+                self.session_store = pickle.loads(self.saved)
                 if 'version' in self.session_store and self.session_store['version'] == self.VERSION:
                     self.sessions = self.session_store['sessions']
                     self.default = self.session_store['default']
@@ -795,15 +896,46 @@ class TidalSessionFile(object):
 
     def _save(self):
         '''
-        Attempts to write current session store to file
+        Attempts to write current session store to file, unless nothing changed since it was read or saved
         '''
 
         self.session_store['version'] = self.VERSION
         self.session_store['sessions'] = self.sessions
         self.session_store['default'] = self.default
 
-        with open(self.session_file, 'wb') as f:
-            pickle.dump(self.session_store, f)
+        with self.save_lock:
+            data = pickle.dumps(self.session_store)
+            if data == self.saved:
+                return
+
+            # Written to a temporary file first, so an interrupted save does not corrupt the session file
+            temp_file = self.session_file + '.tmp'
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.session_file)
+            self.saved = data
+
+    def _check(self, session_name):
+        '''
+        Makes sure a session can be used, the token expiry is checked locally. Only expired sessions are
+        refreshed and validated with a request, a 401 later on is handled by TidalApi
+        '''
+        session = self.sessions[session_name]
+
+        # TODO: Only required for old sessions, remove if possible
+        if not hasattr(session, 'TIDAL_API_BASE'):
+            session.TIDAL_API_BASE = 'https://api.tidal.com/v1/'
+
+        if not session.expired():
+            return
+
+        if isinstance(session, TidalMobileSession) or isinstance(session, TidalTvSession):
+            session.refresh()
+        assert not session.expired() and session.valid(), \
+            '{} has an invalid sessionId. Please re-authenticate'.format(session_name)
+        self._save()
 
     def new_session(self, session_name, username, password, device):
         '''
@@ -851,19 +983,7 @@ class TidalSessionFile(object):
             session_name = self.default
 
         if session_name in self.sessions:
-            # TODO: Only required for old sessions, remove if possible
-            if not hasattr(self.sessions[session_name], 'TIDAL_API_BASE'):
-                self.sessions[session_name].TIDAL_API_BASE = 'https://api.tidal.com/v1/'
-
-            if not self.sessions[session_name].valid() and isinstance(self.sessions[session_name], TidalMobileSession):
-                self.sessions[session_name].refresh()
-            if not self.sessions[session_name].valid() and isinstance(self.sessions[session_name], TidalTvSession):
-                self.sessions[session_name].refresh()
-            assert self.sessions[session_name].valid(), '{} has an invalid sessionId. Please re-authenticate'.format(
-                session_name)
-
-            self._save()
-            
+            self._check(session_name)
             return self.sessions[session_name]
 
         raise ValueError('Session "{}" could not be found.'.format(session_name))
@@ -875,15 +995,6 @@ class TidalSessionFile(object):
         '''
 
         if session_name in self.sessions:
-            # TODO: Only required for old sessions, remove if possible
-            if not hasattr(self.sessions[session_name], 'TIDAL_API_BASE'):
-                self.sessions[session_name].TIDAL_API_BASE = 'https://api.tidal.com/v1/'
-
-            if not self.sessions[session_name].valid() and isinstance(self.sessions[session_name], TidalMobileSession):
-                self.sessions[session_name].refresh()
-            if not self.sessions[session_name].valid() and isinstance(self.sessions[session_name], TidalTvSession):
-                self.sessions[session_name].refresh()
-            assert self.sessions[session_name].valid(), '{} has an invalid sessionId. Please re-authenticate'.format(
-                session_name)
+            self._check(session_name)
             self.default = session_name
             self._save()
@@ -2,24 +2,34 @@ import os
 import re
 import shutil
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 
 import ffmpeg
-import requests
 from mutagen.easymp4 import EasyMP4
 from mutagen.mp4 import MP4Cover
 from mutagen.mp4 import MP4Tags
 
+from . import clients
+from .segments import fetch_segments
+
 # Needed for Windows tagging support
 MP4Tags._padding = 0
 
+def get_session():
+    '''
+    Returns the pooled session shared by all video requests, so segments reuse connections
+    '''
+    return clients.get_session('cdn', pool_size=16)
+
 
 def normalize_key(s):
     # Remove accents from a given string
     return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
 
 
-def parse_master_playlist(masterurl: str):
-    content = str(requests.get(masterurl, verify=False).content)
+def parse_master_playlist(masterurl: str, session=None):
+    session = session or get_session()
+    content = str(session.get(masterurl, verify=False).content)
     pattern = re.compile(r"(?<=RESOLUTION=)[0-9]+x[0-9]+")
     resolution_list = pattern.findall(content)
     pattern = re.compile(r"(?<=http).+?(?=\\n)")
@@ -30,8 +40,9 @@ def parse_master_playlist(masterurl: str):
     return sorted(playlists, key=lambda k: k['height'], reverse=True)
 
 
-def parse_playlist(url: str):
-    content = requests.get(url, verify=False).content
+def parse_playlist(url: str, session=None):
+    session = session or get_session()
+    content = session.get(url, verify=False).content
     pattern = re.compile(r"(?<=http).+?(?=\\n)")
     plist = pattern.findall(str(content))
     urllist = []
@@ -41,24 +52,25 @@ def parse_playlist(url: str):
     return urllist
 
 
-def download_file(urllist: list, part: int, filename: str):
+def download_file(urllist: list, part: int, filename: str, session=None):
     if os.path.isfile(filename):
         # print('\tFile {} already exists, skipping.'.format(filename))
         return None
 
-    r = requests.get(urllist[part], stream=True, verify=False)
+    session = session or get_session()
+    r = session.get(urllist[part], stream=True, verify=False)
     try:
         total = int(r.headers['content-length'])
     except KeyError:
         return False
 
-    with open(filename, 'wb') as f:
-        cc = 0
-        for chunk in r.iter_content(chunk_size=1024):
-            cc += 1024
+    # Only complete files get their final name, so existing files can be skipped when resuming
+    with open(filename + '.part', 'wb') as f:
+        for chunk in r.iter_content(chunk_size=64 * 1024):
             if chunk:  # filter out keep-alive new chunks
                 f.write(chunk)
-    f.close()
+    os.replace(filename + '.part', filename)
+    return True
 
 
 def print_video_info(track_info: dict):
@@ -78,7 +90,7 @@ def download_video_artwork(image_id: str, where: str):
     url = 'https://resources.tidal.com/images/{0}/{1}x{2}.jpg'.format(
         image_id.replace('-', '/'), 1280, 720)
 
-    r = requests.get(url, stream=True, verify=False)
+    r = get_session().get(url, stream=True, verify=False)
 
     try:
         total = int(r.headers['content-length'])
@@ -145,23 +157,11 @@ def tag_video(file_path: str, track_info: dict, credits_dict: dict, album_art_pa
     tagger.save(file_path)
 
 
-def download_stream(folder_path: str, file_name: str, url: str, resolution: int, video_info: dict, credits_dict: dict):
-    tmp_folder = os.path.join(folder_path, 'tmp')
-    playlists = parse_master_playlist(url)
-    urllist = []
-
-    for playlist in playlists:
-        if resolution >= playlist['height']:
-            video_info['resolution'] = playlist['height']
-            urllist = parse_playlist(playlist['url'])
-            break
-
-    if len(urllist) <= 0:
-        print('Error: list of URLs is empty!')
-        return False
-
-    print_video_info(video_info)
-
+def download_segments(tmp_folder: str, urllist: list, file_path: str, workers=8, session=None):
+    '''
+    Downloads the segments into tmp_folder and concatenates them with ffmpeg, segments which already
+    exist in tmp_folder are skipped
+    '''
     if not os.path.isdir(tmp_folder):
         os.makedirs(tmp_folder)
 
@@ -170,27 +170,26 @@ def download_stream(folder_path: str, file_name: str, url: str, resolution: int,
     if os.path.exists(filelist_loc):
         os.remove(filelist_loc)
 
-    filename = ""
-    for i in range(len(urllist)):
+    # Download the segments with several requests in flight, already downloaded segments are skipped
+    filenames = [os.path.join(tmp_folder, str(i).zfill(3) + '.ts') for i in range(len(urllist))]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(download_file, urllist, i, filenames[i], session) for i in range(len(urllist))]
         try:
-            filename = os.path.join(tmp_folder, str(i).zfill(3) + '.ts')
-            download_file(urllist, i, filename)
-            with open(filelist_loc, 'a') as f:
-                f.write("file '" + str(i).zfill(3) + '.ts' + "'\n")
-            percent = i / (len(urllist) - 1) * 100
-            print("\tDownload progress: {0:.0f}%".format(percent), end='\r')
-            # print(percent)
-            
-        # Delete partially downloaded file on keyboard interrupt
+            for i, future in enumerate(futures):
+                future.result()
+                percent = (i + 1) / len(urllist) * 100
+                print("\tDownload progress: {0:.0f}%".format(percent), end='\r')
+
+        # Stop downloading on keyboard interrupt, partial segments are never mistaken for finished ones
         except KeyboardInterrupt:
-            if os.path.isfile(filename):
-                print('\tDeleting partially downloaded file ' + str(filename))
-                os.remove(filename)
+            for future in futures:
+                future.cancel()
             raise
-        #   print("\tDownload progress: {0:.0f}%".format(percent), end='\r')
     print("\n\tDownload succeeded!")
 
-    file_path = os.path.join(folder_path, file_name + '.mp4')
+    with open(filelist_loc, 'w') as f:
+        for filename in filenames:
+            f.write("file '" + os.path.basename(filename) + "'\n")
 
     (
         ffmpeg
@@ -202,6 +201,69 @@ def download_stream(folder_path: str, file_name: str, url: str, resolution: int,
     print('\tConcatenation succeeded!')
     shutil.rmtree(tmp_folder)
 
+
+def pipe_segments(urllist: list, file_path: str, workers=8, session=None):
+    '''
+    Downloads the segments and pipes them in order into ffmpeg which remuxes them to file_path,
+    nothing but the final file is written to disk
+    '''
+    part_path = file_path + '.part'
+    process = (
+        ffmpeg
+            .input('pipe:', format='mpegts')
+            .output(part_path, format='mp4', vcodec='copy', acodec='copy', loglevel='warning')
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
+    )
+
+    try:
+        fetch_segments(session, urllist, process.stdin, workers,
+                       progress=lambda done, total: print(
+                           "\tDownload progress: {0:.0f}%".format(done / total * 100), end='\r'))
+        process.stdin.close()
+        process.wait()
+
+    # Do not leave a half muxed file behind
+    except BaseException:
+        process.kill()
+        process.wait()
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+        raise
+
+    if process.returncode != 0:
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+        raise ffmpeg.Error('ffmpeg', None, None)
+
+    print("\n\tDownload and remuxing succeeded!")
+    os.replace(part_path, file_path)
+
+
+def download_stream(folder_path: str, file_name: str, url: str, resolution: int, video_info: dict, credits_dict: dict,
+                    workers=8, session=None, pipe=False):
+    session = session or get_session()
+    playlists = parse_master_playlist(url, session)
+    urllist = []
+
+    for playlist in playlists:
+        if resolution >= playlist['height']:
+            video_info['resolution'] = playlist['height']
+            urllist = parse_playlist(playlist['url'], session)
+            break
+
+    if len(urllist) <= 0:
+        print('Error: list of URLs is empty!')
+        return False
+
+    print_video_info(video_info)
+
+    file_path = os.path.join(folder_path, file_name + '.mp4')
+    if pipe:
+        pipe_segments(urllist, file_path, workers, session)
+    else:
+        download_segments(os.path.join(folder_path, 'tmp'), urllist, file_path, workers, session)
+
     print('\tDownloading album art ...')
     aa_location = os.path.join(folder_path, 'Cover.jpg')
     if not os.path.isfile(aa_location):